@@ -0,0 +1,98 @@
+import os
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# --- Сбор альбомов ---
+# Окно ожидания следующего файла альбома подстраивается под наблюдаемые интервалы между файлами
+MEDIA_GROUP_MIN_DELAY = float(os.getenv("MEDIA_GROUP_MIN_DELAY", "0.3"))
+MEDIA_GROUP_MAX_DELAY = float(os.getenv("MEDIA_GROUP_MAX_DELAY", "2.0"))
+MEDIA_GROUP_MAX_ITEMS = 10  # больше файлов в одном альбоме Telegram не присылает
+ALBUM_STATE_TTL = int(os.getenv("ALBUM_STATE_TTL", "600"))  # сколько держать проверки и заготовки объединения
+
+
+class AlbumAggregator:
+    """Локальное состояние сбора альбомов в процессе бота:
+    - окно ожидания: оценка интервала между файлами альбома как у TCP RTO (среднее + 4 отклонения);
+    - проверки файлов (скачивание, заголовок, число страниц), которые стартуют сразу при получении файла;
+    - заготовка объединения альбома, которая начинается, не дожидаясь кнопки пользователя."""
+
+    def __init__(self, min_delay: float = MEDIA_GROUP_MIN_DELAY, max_delay: float = MEDIA_GROUP_MAX_DELAY,
+                 max_items: int = MEDIA_GROUP_MAX_ITEMS, ttl: float = ALBUM_STATE_TTL):
+        self.min_delay, self.max_delay, self.max_items, self.ttl = min_delay, max_delay, max_items, ttl
+        # Стартовая оценка дает окно около 1 с, дальше оно учится на реальных альбомах
+        self._gap, self._gap_var = 0.2, 0.2
+        self._groups: dict[str, tuple[float, int]] = {}  # media_group_id -> (время последнего файла, файлов)
+        self._checks: dict[str, tuple[asyncio.Task, float]] = {}  # file_unique_id -> (проверка, когда начата)
+        self._premerges: dict[int, tuple[tuple, asyncio.Task, float]] = {}  # user_id -> (файлы, объединение, когда начато)
+
+    @property
+    def delay(self) -> float:
+        return min(self.max_delay, max(self.min_delay, self._gap + 4 * self._gap_var))
+
+    def _learn(self, gap: float) -> None:
+        gap = min(gap, self.max_delay)
+        error = gap - self._gap
+        self._gap += error / 8; self._gap_var += (abs(error) - self._gap_var) / 4
+
+    def arrived(self, media_group_id: str) -> float:
+        """Учитывает очередной файл альбома и возвращает, сколько еще ждать следующий."""
+        now = time.monotonic()
+        last, count = self._groups.get(media_group_id, (None, 0))
+        if last is not None: self._learn(now - last)
+        self._groups[media_group_id] = (now, count + 1)
+        return 0 if count + 1 >= self.max_items else self.delay
+
+    def finished(self, media_group_id: str) -> None:
+        self._groups.pop(media_group_id, None)
+
+    def check(self, key: str, factory) -> asyncio.Task:
+        """Запускает проверку файла (factory() — корутина), если она еще не идет."""
+        entry = self._checks.get(key)
+        if entry is None:
+            entry = self._checks[key] = (asyncio.ensure_future(factory()), time.monotonic())
+        return entry[0]
+
+    async def results(self, items: list[tuple[str, object]]) -> list:
+        """Дожидается проверок [(ключ, factory)] и забирает их результаты; ошибка проверки возвращается как исключение."""
+        tasks = [self.check(key, factory) for key, factory in items]
+        try: return await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            for key, _ in items: self._checks.pop(key, None)
+
+    def premerge(self, user_id: int, key: tuple, coroutine) -> None:
+        """Начинает объединение альбома заранее: у пользователя одна заготовка, новая заменяет старую.
+        Корутина возвращает путь к результату на диске, а не сами байты."""
+        self.discard(user_id)
+        self._premerges[user_id] = (key, asyncio.ensure_future(coroutine), time.monotonic())
+
+    def take_premerge(self, user_id: int, key: tuple) -> asyncio.Task | None:
+        entry = self._premerges.get(user_id)
+        if entry is None or entry[0] != key: return None
+        del self._premerges[user_id]
+        return entry[1]
+
+    def discard(self, user_id: int) -> None:
+        entry = self._premerges.pop(user_id, None)
+        if entry is not None: _cancel(entry[1])
+
+    def sweep(self) -> None:
+        deadline = time.monotonic() - self.ttl
+        for group_id in [g for g, (last, _) in self._groups.items() if last < deadline]: del self._groups[group_id]
+        for key in [k for k, (_, started) in self._checks.items() if started < deadline]: _cancel(self._checks.pop(key)[0])
+        for user_id in [u for u, (_, _, started) in self._premerges.items() if started < deadline]: self.discard(user_id)
+
+    def stats(self) -> dict:
+        return {"album_delay": round(self.delay, 3), "album_gap": round(self._gap, 3), "albums_open": len(self._groups),
+                "album_checks": len(self._checks), "album_premerges": len(self._premerges)}
+
+
+def _cancel(task: asyncio.Task) -> None:
+    if task.done():
+        if not task.cancelled(): task.exception()  # чтобы asyncio не ругался на непрочитанную ошибку
+    else: task.cancel()
+
+
+album_aggregator = AlbumAggregator()
@@ -0,0 +1,88 @@
+"""Холодный старт бота в режиме вебхука: процесс `python bot.py` против заглушки Bot API.
+Меряется, через сколько после запуска процесса вебхук впервые ответил 200 и через сколько
+бот ответил пользователю на /start. Запуск из корня репозитория:
+
+    python -m benchmarks.cold_start --runs 5
+    python -m benchmarks.cold_start --runs 5 --script /path/to/old/checkout/bot.py   # для сравнения
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+import tempfile
+import urllib.error
+import urllib.request
+from local_bot_api_stub import BotApiStub, serve
+
+CHAT_ID = 1001
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0)); return s.getsockname()[1]
+
+
+def _start_update(update_id: int) -> bytes:
+    message = {"message_id": update_id, "date": int(time.time()), "text": "/start",
+               "chat": {"id": CHAT_ID, "type": "private"}, "from": {"id": CHAT_ID, "is_bot": False, "first_name": "Bench"},
+               "entities": [{"type": "bot_command", "offset": 0, "length": 6}]}
+    return json.dumps({"update_id": update_id, "message": message}).encode()
+
+
+def measure(script: str, timeout: float, prewarm: bool) -> dict:
+    with tempfile.TemporaryDirectory() as files_dir:
+        stub = BotApiStub(files_dir)
+        api = serve(stub)
+        port, token = _free_port(), "1:cold"
+        env = {**os.environ, "TELEGRAM_TOKEN": token, "RENDER_EXTERNAL_URL": "http://127.0.0.1",
+               "PORT": str(port), "BOT_API_URL": f"http://127.0.0.1:{api.server_address[1]}",
+               "PDF_PREWARM": "1" if prewarm else "0", "STATE_DB": ""}
+        started = time.perf_counter()
+        process = subprocess.Popen([sys.executable, script], env=env, cwd=os.path.dirname(os.path.abspath(script)),
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        result = {"first_200_s": None, "first_reply_s": None}
+        try:
+            # Как Telegram: повторяем доставку, пока вебхук не ответит 200
+            while result["first_200_s"] is None and time.perf_counter() - started < timeout:
+                request = urllib.request.Request(f"http://127.0.0.1:{port}/{token}", data=_start_update(1),
+                                                 headers={"Content-Type": "application/json"})
+                try:
+                    with urllib.request.urlopen(request, timeout=1) as response:
+                        if response.status == 200: result["first_200_s"] = time.perf_counter() - started
+                except (urllib.error.URLError, ConnectionError, OSError): time.sleep(0.005)
+            while time.perf_counter() - started < timeout:
+                if any(r.get("chat_id") == CHAT_ID and r["method"] == "sendMessage" for r in stub.sent):
+                    result["first_reply_s"] = time.perf_counter() - started; break
+                time.sleep(0.005)
+        finally:
+            process.terminate()
+            try: _, stderr = process.communicate(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill(); _, stderr = process.communicate()
+            api.shutdown()
+        # Разбивка старта, которую бот пишет в лог (если умеет)
+        result["startup_log"] = next((line.split(" - ", 3)[-1] for line in stderr.splitlines() if "после старта процесса:" in line), None)
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Холодный старт бота в режиме вебхука")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--script", default="bot.py", help="какой bot.py запускать (например, из старой копии репозитория)")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--prewarm", action="store_true", help="PDF_PREWARM=1: прогревать пул PDF-процессов при старте")
+    args = parser.parse_args()
+    runs = [measure(args.script, args.timeout, args.prewarm) for _ in range(args.runs)]
+    for i, run in enumerate(runs, 1):
+        print(f"#{i}: 200 через {run['first_200_s']}, ответ через {run['first_reply_s']}" + (f"\n    {run['startup_log']}" if run["startup_log"] else ""))
+    for key in ("first_200_s", "first_reply_s"):
+        values = [run[key] for run in runs if run[key] is not None]
+        if values: print(f"{key}: медиана {statistics.median(values):.3f} с, мин {min(values):.3f} с ({len(values)}/{len(runs)})")
+
+
+if __name__ == "__main__":
+    main()
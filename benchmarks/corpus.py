@@ -0,0 +1,72 @@
+"""Синтетические PDF для бенчмарков: много страниц, крупные картинки, тяжелые встроенные шрифты."""
+import os
+import random
+import fitz  # PyMuPDF
+
+_LOREM = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit. Съешь же ещё этих мягких "
+          "французских булок, да выпей чаю. ").split()
+
+
+def text_pdf(pages: int, seed: int = 0) -> bytes:
+    """Много страниц обычного текста со стандартным шрифтом."""
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for number in range(pages):
+        page = doc.new_page()
+        text = "\n".join(" ".join(rng.choices(_LOREM, k=12)) for _ in range(40))
+        page.insert_text((50, 60), f"Страница {number + 1}\n{text}", fontname="helv", fontsize=9)
+    data = doc.tobytes(garbage=1, deflate=True); doc.close()
+    return data
+
+
+def image_pdf(pages: int, image_size: int = 1200, seed: int = 0) -> bytes:
+    """Страницы с крупной несжимаемой картинкой (шум), у каждой страницы своя."""
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for number in range(pages):
+        page = doc.new_page()
+        pix = fitz.Pixmap(fitz.csRGB, image_size, image_size, rng.randbytes(image_size * image_size * 3), False)
+        page.insert_image(page.rect, pixmap=pix)
+        page.insert_text((50, 40), f"Скан {number + 1}", fontname="helv", fontsize=14)
+    data = doc.tobytes(deflate=True); doc.close()
+    return data
+
+
+def font_pdf(pages: int, seed: int = 0) -> bytes:
+    """Страницы с полностью встроенным CJK-шрифтом (несколько МБ на файл)."""
+    rng = random.Random(seed)
+    font = fitz.Font("cjk")
+    doc = fitz.open()
+    for number in range(pages):
+        page = doc.new_page()
+        page.insert_font(fontname="cjk", fontbuffer=font.buffer)
+        text = "".join(chr(rng.randint(0x4E00, 0x9FA5)) for _ in range(600))
+        page.insert_textbox(page.rect + (50, 50, -50, -50), f"{number + 1} {text}", fontname="cjk", fontsize=11)
+    data = doc.tobytes(deflate=True); doc.close()
+    return data
+
+
+# Размеры корпуса: (страниц в текстовом, страниц с картинками, сторона картинки, страниц со шрифтом)
+SCALES = {
+    "small": (40, 4, 600, 2),
+    "medium": (200, 12, 1200, 4),
+    "large": (1000, 30, 2000, 8),
+}
+
+
+def build_corpus(directory: str, scale: str = "small") -> dict[str, str]:
+    """Создает файлы корпуса в каталоге и возвращает {имя: путь}. Имя файла — это и file_id для заглушки."""
+    text_pages, image_pages, image_size, font_pages = SCALES[scale]
+    os.makedirs(directory, exist_ok=True)
+    files = {
+        "text.pdf": text_pdf(text_pages),
+        "images.pdf": image_pdf(image_pages, image_size),
+        "fonts.pdf": font_pdf(font_pages),
+    }
+    # Небольшие разные файлы для объединения и сборки
+    for i in range(5): files[f"part_{i + 1}.pdf"] = text_pdf(max(text_pages // 10, 2), seed=i + 1)
+    paths = {}
+    for name, data in files.items():
+        path = paths[name] = os.path.join(directory, name)
+        with open(path, "wb") as f: f.write(data)
+    return paths
@@ -0,0 +1,55 @@
+"""Транспорт Bot API для бенчмарков: запросы бота обрабатывает BotApiStub прямо в процессе,
+а сеть имитируется задержкой и пропускной способностью."""
+import json
+import asyncio
+from urllib.parse import unquote
+from telegram.request import BaseRequest, RequestData
+from local_bot_api_stub import BotApiStub
+
+
+class FakeRequest(BaseRequest):
+    """Подставляется в Application.builder().request(...) вместо HTTPXRequest.
+    Каждый запрос стоит latency секунд плюс время передачи тела со скоростью bandwidth байт/с."""
+
+    def __init__(self, stub: BotApiStub, latency: float = 0.05, bandwidth: float = 10 * 1024 * 1024):
+        self.stub, self.latency, self.bandwidth = stub, latency, bandwidth
+        self.requests = 0
+        self.bytes_in = self.bytes_out = 0  # скачано ботом / загружено ботом
+
+    @property
+    def read_timeout(self) -> float | None:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def _transfer(self, size: int) -> None:
+        await asyncio.sleep(self.latency + (size / self.bandwidth if self.bandwidth else 0))
+
+    async def do_request(self, url: str, method: str, request_data: RequestData | None = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None) -> tuple[int, bytes]:
+        self.requests += 1
+        if method == "GET":
+            # .../file/bot<token>/<file_path> — скачивание файла
+            path = self.stub.file_path(unquote(url.rsplit("/", 1)[-1]))
+            if path is None: return 404, b""
+            data = await asyncio.to_thread(_read_file, path)
+            self.bytes_in += len(data); await self._transfer(len(data))
+            return 200, data
+        params = request_data.json_parameters if request_data else {}
+        files = {}
+        if request_data is not None and request_data.contains_files:
+            files = {name: (filename, content) for name, (filename, content, *_) in request_data.multipart_data.items()}
+        size = sum(len(content) for _, content in files.values())
+        self.bytes_out += size; await self._transfer(size)
+        try: result = await asyncio.to_thread(self.stub.handle, url.rsplit("/", 1)[-1], params, files)
+        except ValueError as e:
+            return 400, json.dumps({"ok": False, "error_code": 400, "description": str(e)}).encode()
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f: return f.read()
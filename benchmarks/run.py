@@ -0,0 +1,211 @@
+"""Офлайн-бенчмарк обработчиков бота: настоящий Application и ConversationHandler,
+фейковый Bot API в процессе и синтетические PDF. Запуск из корня репозитория:
+
+    python -m benchmarks.run --users 8 --scale medium --output before.json
+    python -m benchmarks.run --users 8 --scale medium --output after.json --compare before.json
+
+Для каждого сценария выводятся время (wall), CPU (включая процессы пула), пиковый RSS
+(бот + процессы пула), p50/p95 задержки последнего шага и всего диалога.
+"""
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import fitz  # PyMuPDF
+import bot
+import delivery
+import pdf_engine
+from file_cache import FileCache
+from local_bot_api_stub import BotApiStub
+from benchmarks.corpus import SCALES, build_corpus
+from benchmarks.fake_bot import FakeRequest
+from benchmarks.scenarios import SCENARIOS, SimUser
+
+# Метрики, которые сравниваются между запусками (меньше — лучше)
+COMPARED_METRICS = ("wall_s", "cpu_s", "peak_rss_mb", "action_p50_s", "action_p95_s", "flow_p95_s")
+
+
+class _NoLimit:
+    """Лимиты Telegram в бенчмарке по умолчанию выключены: они мерили бы только сами себя."""
+
+    async def acquire(self, chat_id: int, messages: int = 1) -> None:
+        pass
+
+    def retry_after(self, chat_id: int, seconds: float) -> None:
+        pass
+
+
+def _rss_bytes(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"): return int(line.split()[1]) * 1024
+    except OSError: pass
+    return 0
+
+
+class RssSampler:
+    """Пиковый суммарный RSS бота и процессов пула. Отдельный поток, чтобы замер не зависел от цикла событий."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval, self.peak = interval, 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _current(self) -> int:
+        executor = pdf_engine._executor
+        workers = list(executor._processes or {}) if executor is not None else []
+        return _rss_bytes(os.getpid()) + sum(_rss_bytes(pid) for pid in workers)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._current()); self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start(); return self
+
+    def __exit__(self, *exc):
+        self._stop.set(); self._thread.join()
+
+
+def _cpu_seconds() -> float:
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def percentile(values: list[float], p: float) -> float | None:
+    if not values: return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p * len(ordered)) - 1)]
+
+
+async def run_scenario(name: str, corpus: dict[str, str], workdir: str, args) -> dict:
+    stub = BotApiStub(os.path.dirname(next(iter(corpus.values()))), sent_dir=os.path.join(workdir, f"sent_{name}"), local_mode=args.local)
+    request = FakeRequest(stub, latency=args.latency, bandwidth=args.bandwidth * 1024 * 1024)
+    # Свежий кэш на каждый сценарий, чтобы сценарии не грели его друг другу
+    bot.file_cache = FileCache(cache_dir=os.path.join(workdir, f"cache_{name}"))
+    app = bot.build_application("1:bench", request=request)
+    await app.initialize(); await app.start()
+    # Пул процессов поднимается до замера, как у уже работающего бота
+    await pdf_engine.page_count(corpus["part_1.pdf"])
+    users = [SimUser(app, stub, 1000 + i, corpus, shared_files=args.shared_files) for i in range(args.users)]
+    flow_times: list[float] = []
+
+    async def run_user(user: SimUser, delay: float) -> None:
+        await asyncio.sleep(delay)
+        started = time.perf_counter()
+        try: await asyncio.wait_for(SCENARIOS[name](user), args.timeout)
+        except Exception as e: logging.getLogger(__name__).warning(f"{name}: пользователь {user.user_id}: {e!r}")
+        flow_times.append(time.perf_counter() - started)
+
+    cpu_started, wall_started = _cpu_seconds(), time.perf_counter()
+    with RssSampler() as sampler:
+        await asyncio.gather(*(run_user(user, i * args.stagger) for i, user in enumerate(users)))
+        wall = time.perf_counter() - wall_started
+        await app.stop()
+        # Дожидаемся процессов пула, чтобы их CPU попал в os.times().children_*
+        pdf_engine.shutdown_executor(wait=True)
+    cpu = _cpu_seconds() - cpu_started
+    await app.shutdown()
+
+    action_times = [user.action_time for user in users if user.action_time is not None]
+    return {
+        "users": args.users,
+        "wall_s": round(wall, 3),
+        "cpu_s": round(cpu, 3),
+        "peak_rss_mb": round(sampler.peak / 1024 / 1024, 1),
+        "action_p50_s": _round(percentile(action_times, 0.5)),
+        "action_p95_s": _round(percentile(action_times, 0.95)),
+        "flow_p50_s": _round(percentile(flow_times, 0.5)),
+        "flow_p95_s": _round(percentile(flow_times, 0.95)),
+        "failures": sum(not user.succeeded for user in users),
+        "api_requests": request.requests,
+        "bytes_downloaded": request.bytes_in,
+        "bytes_uploaded": request.bytes_out,
+        "files_sent": sum(1 for record in stub.sent if "size" in record),
+        "cache": bot.file_cache.stats(),
+    }
+
+
+def _round(value: float | None) -> float | None:
+    return None if value is None else round(value, 3)
+
+
+def _git_revision() -> str | None:
+    try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError): return None
+
+
+def compare(old: dict, new: dict) -> str:
+    lines = [f"{'сценарий':<16}{'метрика':<14}{'было':>10}{'стало':>10}{'изм.':>9}"]
+    for name, result in new["scenarios"].items():
+        previous = old.get("scenarios", {}).get(name)
+        if previous is None: continue
+        for metric in COMPARED_METRICS:
+            before, after = previous.get(metric), result.get(metric)
+            if before is None or after is None: continue
+            change = f"{(after - before) / before * 100:+.1f}%" if before else "—"
+            lines.append(f"{name:<16}{metric:<14}{before:>10}{after:>10}{change:>9}")
+    return "\n".join(lines)
+
+
+async def main_async(args) -> dict:
+    if not args.rate_limits: delivery.limiter = _NoLimit()
+    if args.local: os.environ["BOT_API_URL"] = "http://bench.invalid"  # адрес не используется, важен сам локальный режим
+    with tempfile.TemporaryDirectory(prefix="pdf_bot_bench_") as workdir:
+        started = time.perf_counter()
+        corpus = build_corpus(os.path.join(workdir, "files"), args.scale)
+        print(f"Корпус {args.scale} готов за {time.perf_counter() - started:.1f} с", file=sys.stderr)
+        results = {}
+        for name in args.scenarios:
+            results[name] = await run_scenario(name, corpus, workdir, args)
+            r = results[name]
+            print(f"{name:<16} wall {r['wall_s']:>7} с  cpu {r['cpu_s']:>7} с  rss {r['peak_rss_mb']:>7} МБ  "
+                  f"p50 {r['action_p50_s']} с  p95 {r['action_p95_s']} с  ошибок {r['failures']}", file=sys.stderr)
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "revision": _git_revision(),
+            "python": platform.python_version(), "pymupdf": fitz.VersionBind, "cpu_count": os.cpu_count(),
+            "scale": args.scale, "users": args.users, "latency_s": args.latency, "bandwidth_mb_s": args.bandwidth,
+            "local_mode": args.local, "rate_limits": args.rate_limits, "shared_files": args.shared_files,
+        },
+        "scenarios": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк PDF-бота")
+    parser.add_argument("--users", type=int, default=4, help="одновременных пользователей в каждом сценарии")
+    parser.add_argument("--scale", choices=SCALES, default="small", help="размер синтетических PDF")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка одного запроса к Bot API, с")
+    parser.add_argument("--bandwidth", type=float, default=10, help="скорость канала к Bot API, МБ/с (0 — без ограничения)")
+    parser.add_argument("--stagger", type=float, default=0, help="пауза между стартами пользователей, с")
+    parser.add_argument("--timeout", type=float, default=300, help="таймаут одного диалога, с")
+    parser.add_argument("--local", action="store_true", help="режим локального Bot API сервера (файлы по путям)")
+    parser.add_argument("--rate-limits", action="store_true", help="включить лимиты отправки Telegram")
+    parser.add_argument("--shared-files", action="store_true", help="все пользователи шлют одни и те же файлы (проверка кэша)")
+    parser.add_argument("--output", help="куда сохранить результаты в JSON")
+    parser.add_argument("--compare", help="JSON предыдущего запуска для сравнения")
+    parser.add_argument("--verbose", action="store_true", help="не приглушать логи бота")
+    args = parser.parse_args()
+    if not args.verbose: logging.getLogger().setLevel(logging.WARNING)
+
+    report = asyncio.run(main_async(args))
+    if args.output:
+        with open(args.output, "w") as f: json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare) as f: print(compare(json.load(f), report))
+    if not args.output and not args.compare: print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Сценарии бенчмарка: каждый пользователь проходит диалог целиком — от /start до результата —
+через настоящие обработчики и ConversationHandler бота. Отдельно замеряется последний шаг,
+на котором работает сам обработчик (split_file_handler, combine_files_handler и т. д.)."""
+import os
+import time
+import asyncio
+import itertools
+from telegram import Update
+from telegram.ext import Application
+from local_bot_api_stub import BotApiStub
+
+_update_ids = itertools.count(1)
+
+
+class SimUser:
+    """Пользователь в личном чате с ботом (chat_id = user_id). Обновления подаются в приложение
+    так же, как их подает Updater: через update_processor, то есть с очередью и параллельностью бота."""
+
+    def __init__(self, app: Application, stub: BotApiStub, user_id: int, corpus: dict[str, str], shared_files: bool = False):
+        self.app, self.stub, self.user_id, self.corpus, self.shared_files = app, stub, user_id, corpus, shared_files
+        self._message_ids = itertools.count(1)
+        self.action_time: float | None = None
+
+    def _base(self) -> dict:
+        return {"message_id": next(self._message_ids), "date": int(time.time()),
+                "chat": {"id": self.user_id, "type": "private"},
+                "from": {"id": self.user_id, "is_bot": False, "first_name": f"User{self.user_id}"}}
+
+    async def _feed(self, payload: dict) -> None:
+        update = Update.de_json({"update_id": next(_update_ids), **payload}, self.app.bot)
+        await self.app.update_processor.process_update(update, self.app.process_update(update))
+
+    async def command(self, text: str) -> None:
+        command = text.split()[0]
+        await self._feed({"message": {**self._base(), "text": text, "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}]}})
+
+    async def text(self, text: str) -> None:
+        await self._feed({"message": {**self._base(), "text": text}})
+
+    async def press(self, data: str) -> None:
+        message = {**self._base(), "from": {"id": 1, "is_bot": True, "first_name": "Bot"}, "text": "..."}
+        await self._feed({"callback_query": {"id": f"{self.user_id}:{data}", "chat_instance": str(self.user_id),
+                                             "from": self._base()["from"], "data": data, "message": message}})
+
+    async def document(self, name: str, media_group_id: str | None = None) -> None:
+        # file_id — имя файла для заглушки; file_unique_id у каждого пользователя свой, чтобы не мерить кэш между ними
+        unique_id = name if self.shared_files else f"{self.user_id}-{name}"
+        document = {"file_id": name, "file_unique_id": unique_id, "file_name": name,
+                    "mime_type": "application/pdf", "file_size": os.path.getsize(self.corpus[name])}
+        message = {**self._base(), "document": document}
+        if media_group_id: message["media_group_id"] = media_group_id
+        await self._feed({"message": message})
+
+    async def action(self, step) -> None:
+        """Выполняет последний шаг сценария и запоминает, сколько он занял."""
+        started = time.perf_counter()
+        await step
+        self.action_time = time.perf_counter() - started
+
+    def texts(self) -> list[str]:
+        return [r.get("text") or "" for r in list(self.stub.sent) if r["chat_id"] == self.user_id and "text" in r]
+
+    async def wait_for_text(self, fragment: str, timeout: float = 30) -> None:
+        deadline = time.monotonic() + timeout
+        while not any(fragment in text for text in self.texts()):
+            if time.monotonic() > deadline: raise TimeoutError(f"Бот не прислал «{fragment}»")
+            await asyncio.sleep(0.01)
+
+    @property
+    def succeeded(self) -> bool:
+        return any(text.startswith("Готово") for text in self.texts())
+
+
+async def split_single(user: SimUser) -> None:
+    await user.command("/start"); await user.press("split"); await user.press("split_single")
+    await user.action(user.document("text.pdf"))
+
+
+async def split_images(user: SimUser) -> None:
+    await user.command("/start"); await user.press("split"); await user.press("split_double")
+    await user.action(user.document("images.pdf"))
+
+
+async def combine(user: SimUser) -> None:
+    await user.command("/start"); await user.press("combine")
+    for i in range(5): await user.document(f"part_{i + 1}.pdf")
+    await user.document("images.pdf")
+    await user.action(user.press("process_done"))
+
+
+async def combine_email(user: SimUser) -> None:
+    await user.command("/start"); await user.press("combine")
+    for i in range(5): await user.document(f"part_{i + 1}.pdf")
+    await user.document("images.pdf"); await user.document("fonts.pdf"); await user.document("fonts.pdf")
+    await user.action(user.press("process_done_email"))
+
+
+async def album_combine(user: SimUser) -> None:
+    # Альбом: файлы приходят одной группой, а кнопка появляется после таймера сбора альбома
+    await user.command("/start")
+    started = time.perf_counter()
+    for i in range(5): await user.document(f"part_{i + 1}.pdf", media_group_id=f"album-{user.user_id}")
+    await user.wait_for_text("Что с ними сделать?")
+    await user.press("group_combine")
+    user.action_time = time.perf_counter() - started
+
+
+async def assembly(user: SimUser) -> None:
+    await user.command("/start"); await user.press("assembly")
+    await user.document("fonts.pdf")
+    for i in range(5): await user.document(f"part_{i + 1}.pdf")
+    await user.action(user.press("process_done"))
+
+
+async def pdf_to_img(user: SimUser) -> None:
+    await user.command("/start"); await user.press("pdf_to_img")
+    await user.document("text.pdf")
+    await user.action(user.text("1-12 jpg 100dpi"))
+
+
+async def pdf_to_img_zip(user: SimUser) -> None:
+    await user.command("/start"); await user.press("pdf_to_img")
+    await user.document("images.pdf")
+    await user.action(user.text("все png 72dpi zip"))
+
+
+SCENARIOS = {
+    "split_single": split_single,
+    "split_images": split_images,
+    "combine": combine,
+    "combine_email": combine_email,
+    "album_combine": album_combine,
+    "assembly": assembly,
+    "pdf_to_img": pdf_to_img,
+    "pdf_to_img_zip": pdf_to_img_zip,
+}
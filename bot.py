@@ -1,24 +1,48 @@
 import os
 import logging
+
+# --- Настройка логирования ---
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+def run_webhook_mode(token: str, webhook_url: str) -> None:
+    # Порт открывается до импорта telegram.ext, PyMuPDF и обработчиков: Telegram сразу получает 200,
+    # а бот (модуль bot) загружается в фоне и забирает накопленные обновления (см. webhook_server)
+    from webhook_server import import_application, run_webhook
+    port = int(os.environ.get('PORT', '8443'))
+    run_webhook(import_application("bot", token), listen="0.0.0.0", port=port, url_path=token, webhook_url=f"{webhook_url}/{token}")
+
+if __name__ == "__main__" and os.getenv("RENDER_EXTERNAL_URL") and os.getenv("TELEGRAM_TOKEN"):
+    run_webhook_mode(os.environ["TELEGRAM_TOKEN"], os.environ["RENDER_EXTERNAL_URL"])
+    raise SystemExit
+
 import re
+import time
+import tempfile
+import zipfile
+import asyncio
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import FileSizeLimit
+from telegram.request import BaseRequest
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     filters,
     ContextTypes,
-    ConversationHandler,
     CallbackQueryHandler,
 )
-import fitz  # PyMuPDF
-from collections import defaultdict
-
-# --- Настройка логирования ---
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
-logger = logging.getLogger(__name__)
+from contextlib import AsyncExitStack, aclosing
+import pdf_engine
+import metrics
+from delivery import Delivery, UPLOAD_DIR, safe_filename
+from file_cache import file_cache
+from update_processor import ChatSerialUpdateProcessor
+from session_store import blob_store, media_group_files, SessionStoreFull
+from album_aggregator import album_aggregator
+from state_backend import STATE_DB, backend, BackendPersistence, SharedConversationHandler
 
 # --- Состояния ---
 CHOOSE_ACTION, CHOOSE_SPLIT_MODE, AWAIT_SPLIT_FILE, AWAIT_SPLIT_ORDER, \
@@ -47,16 +71,20 @@ SPLIT_MODE_KEYBOARD = InlineKeyboardMarkup([
 
 GROUP_ACTION_KEYBOARD = InlineKeyboardMarkup([
     [InlineKeyboardButton("🖇️ Объединить все в один файл", callback_data="group_combine")],
+    [InlineKeyboardButton("📧 Объединить и сжать для почты", callback_data="group_combine_email")],
     [InlineKeyboardButton("« Отмена", callback_data="main_menu")],
 ])
 
-# --- Глобальный словарь для сбора медиагрупп ---
-media_group_files = defaultdict(list)
-
 # --- ОСНОВНЫЕ ФУНКЦИИ ДИАЛОГА ---
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+def clear_session(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Вместе с user_data удаляем и временные файлы пользователя
+    if update.effective_user:
+        blob_store.release_user(update.effective_user.id); album_aggregator.discard(update.effective_user.id)
     context.user_data.clear()
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    clear_session(update, context)
     await update.message.reply_text(
         "Здравствуйте! Я ваш помощник для работы с PDF.\n\nВыберите, что вы хотите сделать:",
         reply_markup=MAIN_KEYBOARD
@@ -66,12 +94,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    context.user_data.clear()
+    clear_session(update, context)
     await query.edit_message_text("Выберите, что вы хотите сделать:", reply_markup=MAIN_KEYBOARD)
     return CHOOSE_ACTION
 
 async def return_to_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, message: str) -> int:
-    context.user_data.clear()
+    clear_session(update, context)
     chat_id = update.effective_chat.id
     if update.callback_query:
         await update.callback_query.answer()
@@ -81,11 +109,55 @@ async def return_to_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE
     return CHOOSE_ACTION
 
 # --- ЛОГИКА ОБРАБОТКИ ФАЙЛОВ ---
+def _read_head(path: str, size: int = 1024) -> bytes:
+    with open(path, "rb") as f: return f.read(size)
+
+async def check_album_file(bot, document) -> int:
+    """Скачивает файл альбома и проверяет, что это PDF; возвращает число страниц."""
+    source = await file_cache.get_source(bot, document)
+    head = await asyncio.to_thread(_read_head, source) if isinstance(source, str) else source[:1024]
+    if b"%PDF-" not in head: raise ValueError(f"{document.file_name}: нет заголовка PDF")
+    return await pdf_engine.page_count(source)
+
 async def process_media_group(context: ContextTypes.DEFAULT_TYPE):
-    job_data = context.job.data; media_group_id, chat_id, user_id, action = job_data['media_group_id'], job_data['chat_id'], job_data['user_id'], job_data['action']
-    documents = media_group_files.pop(media_group_id, [])
+    await flush_media_group(context, context.job.data['media_group_id'])
+
+async def flush_due_media_groups(context: ContextTypes.DEFAULT_TYPE):
+    # Подбирает альбомы, таймер которых был на другом экземпляре бота или потерялся при перезапуске
+    for media_group_id in await media_group_files.due(): await flush_media_group(context, media_group_id)
+
+def start_album_premerge(context: ContextTypes.DEFAULT_TYPE, user_id: int, documents) -> None:
+    async def premerge() -> str:
+        sources = file_cache.iter_ordered(context.bot, documents, as_source=True)
+        merged = await pdf_engine.merge_stream(sources, pdf_engine.WRITE_PROFILES["fast"])
+        # Заготовка ждет кнопки на диске, в бюджете и со сроком жизни временных файлов пользователя
+        return await blob_store.put(user_id, merged)
+    album_aggregator.premerge(user_id, tuple(d.file_unique_id for d in documents), premerge())
+
+async def flush_media_group(context: ContextTypes.DEFAULT_TYPE, media_group_id: str):
+    deadline = await media_group_files.deadline(media_group_id)
+    if deadline is None or deadline > time.time(): return  # пришел еще файл, таймер перезапущен
+    popped = await media_group_files.pop(media_group_id)
+    if popped is None: return
+    documents, meta = popped; chat_id, user_id, action = meta['chat_id'], meta['user_id'], meta['action']
+    album_aggregator.finished(media_group_id)
+    if not documents: return
+    # Из отдельного альбома можно только объединить файлы, поэтому начинаем сразу — на уже скачанных
+    # файлах, не дожидаясь проверок; если какой-то файл окажется битым, заготовка начнется заново без него
+    premerge = action not in ['combine', 'assembly_unique'] and len(documents) >= 2
+    if premerge: start_album_premerge(context, user_id, documents)
+    # Проверки начались, когда пришел каждый файл; здесь обычно осталось дождаться последнего
+    checks = await album_aggregator.results([(d.file_unique_id, lambda d=d: check_album_file(context.bot, d)) for d in documents])
+    broken = [d.file_name for d, result in zip(documents, checks) if isinstance(result, BaseException)]
+    documents = [d for d, result in zip(documents, checks) if not isinstance(result, BaseException)]
+    if broken:
+        await context.bot.send_message(chat_id, f"Эти файлы не удалось прочитать как PDF, я их пропущу: {', '.join(broken)}")
+        if premerge:
+            if len(documents) >= 2: start_album_premerge(context, user_id, documents)
+            else: album_aggregator.discard(user_id)
     if not documents: return
-    user_data = context.application.user_data.get(user_id, {})
+    user_data = context.application.user_data[user_id]
+    if context.application.persistence: await context.application.persistence.refresh_user_data(user_id, user_data)
     if action in ['combine', 'assembly_unique']:
         if 'files_to_process' not in user_data: user_data['files_to_process'] = []
         user_data['files_to_process'].extend(documents)
@@ -93,19 +165,26 @@ async def process_media_group(context: ContextTypes.DEFAULT_TYPE):
     else:
         user_data['group_files_to_process'] = documents
         await context.bot.send_message(chat_id, f"Я получила {len(documents)} файла(ов). Что с ними сделать?", reply_markup=GROUP_ACTION_KEYBOARD)
-    context.application.user_data[user_id] = user_data
+    context.application.mark_data_for_update_persistence(user_ids=user_id)
 
 async def document_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    document = update.message.document
+    if not context.bot.local_mode and (document.file_size or 0) > FileSizeLimit.FILESIZE_DOWNLOAD:
+        # Без локального Bot API сервера Telegram не отдает боту файлы больше 20 МБ
+        await update.message.reply_text(f"Файл '{document.file_name}' больше 20 МБ, такой файл я не могу скачать.")
+        return None
     if update.message.media_group_id:
-        media_group_id = update.message.media_group_id; media_group_files[media_group_id].append(update.message.document)
-        expected_action = context.user_data.get('awaiting_file_for')
+        media_group_id = update.message.media_group_id; expected_action = context.user_data.get('awaiting_file_for')
+        # Файл начинает качаться и проверяться сразу, а окно ожидания остальных подстраивается под их темп
+        delay = album_aggregator.arrived(media_group_id)
+        album_aggregator.check(document.file_unique_id, lambda: check_album_file(context.bot, document))
+        await media_group_files.append(
+            media_group_id, document, deadline=time.time() + delay,
+            meta={'chat_id': update.effective_chat.id, 'user_id': update.effective_user.id, 'action': expected_action})
         jobs = context.job_queue.get_jobs_by_name(str(media_group_id))
         for job in jobs: job.schedule_removal()
-        context.job_queue.run_once(
-            process_media_group, when=1.5,
-            data={'media_group_id': media_group_id, 'chat_id': update.effective_chat.id, 'user_id': update.effective_user.id, 'action': expected_action},
-            name=str(media_group_id))
-        return context.conversation_state
+        context.job_queue.run_once(process_media_group, when=delay, data={'media_group_id': media_group_id}, name=str(media_group_id))
+        return None  # состояние диалога не меняется
     else:
         expected_action = context.user_data.pop('awaiting_file_for', None)
         if expected_action == 'split': return await split_file_handler(update, context)
@@ -117,28 +196,54 @@ async def document_router(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             document = update.message.document
             if document.mime_type != 'application/pdf':
                 await update.message.reply_text("Это не PDF-файл."); return CHOOSE_ACTION
-            context.user_data['file_to_split'] = document; safe_filename = escape_markdown_v2(document.file_name)
+            context.user_data['file_to_split'] = document; file_cache.prefetch(context.bot, document)
+            safe_filename = escape_markdown_v2(document.file_name)
             await update.message.reply_text(f"Я получила файл `{safe_filename}`\nКак именно вы хотите его разбить?", reply_markup=SPLIT_MODE_KEYBOARD, parse_mode='MarkdownV2')
             return CHOOSE_SPLIT_MODE
 
 # --- НОВЫЙ БЛОК: ЛОГИКА "PDF В КАРТИНКИ" ---
 
 def parse_page_ranges(range_str: str, max_pages: int) -> list[int]:
+    # Диапазоны обрезаются по числу страниц до перебора, поэтому "1-1000000000" не дороже "1-<последняя>"
     if range_str.lower() == 'все': return list(range(max_pages))
-    pages = set()
+    intervals = []
     try:
-        parts = range_str.split(',');
-        for part in parts:
+        for part in range_str.split(','):
             part = part.strip()
-            if '-' in part:
-                start, end = map(int, part.split('-'))
-                for i in range(start, end + 1):
-                    if 1 <= i <= max_pages: pages.add(i - 1)
-            else:
-                page_num = int(part)
-                if 1 <= page_num <= max_pages: pages.add(page_num - 1)
+            if '-' in part: start, end = map(int, part.split('-'))
+            else: start = end = int(part)
+            start, end = max(start, 1), min(end, max_pages)
+            if start <= end: intervals.append((start - 1, end - 1))
     except ValueError: return []
-    return sorted(list(pages))
+    pages = []
+    for start, end in sorted(intervals):
+        if pages: start = max(start, pages[-1] + 1)  # пересечения диапазонов не дают повторов
+        pages.extend(range(start, end + 1))
+    return pages
+
+IMAGE_FORMATS = {'png': 'png', 'jpg': 'jpg', 'jpeg': 'jpg', 'webp': 'webp'}
+# WebP предлагаем, только если он доступен (нужен Pillow)
+IMAGE_FORMATS_HINT = "`png`/`jpg`/`webp`" if pdf_engine.WEBP_AVAILABLE else "`png`/`jpg`"
+GRAYSCALE_WORDS = {'чб', 'ч/б', 'серый', 'серые', 'gray', 'grey'}
+
+def parse_image_options(text: str) -> tuple[str, pdf_engine.RenderOptions, str] | None:
+    """Разбирает "1-3, 5 jpg q70 150dpi ч/б zip" на диапазон страниц, параметры рендера и способ отправки.
+    Без параметров — как раньше: PNG 200 DPI отдельными файлами."""
+    fmt, dpi, quality, grayscale, output = 'png', 200, 85, False, 'files'
+    range_words = []
+    for word in text.lower().split():
+        if word in IMAGE_FORMATS: fmt = IMAGE_FORMATS[word]
+        elif match := re.fullmatch(r'(\d+)dpi', word): dpi = int(match.group(1))
+        elif match := re.fullmatch(r'q(\d+)', word): quality = int(match.group(1))
+        elif word in GRAYSCALE_WORDS: grayscale = True
+        elif word in ('zip', 'архив'): output = 'zip'
+        elif word in ('альбом', 'album'): output = 'album'
+        else: range_words.append(word)
+    if fmt == 'webp' and not pdf_engine.WEBP_AVAILABLE: return None
+    if not 36 <= dpi <= 600 or not 1 <= quality <= 100: return None
+    if output == 'album': dpi = min(dpi, 300)  # у фото в Telegram ограничен размер сторон
+    options = pdf_engine.RenderOptions(dpi=dpi, fmt=fmt, quality=quality, grayscale=grayscale)
+    return ' '.join(range_words) or 'все', options, output
 
 async def ask_for_pdf_to_image_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query; await query.answer()
@@ -146,33 +251,73 @@ async def ask_for_pdf_to_image_file(update: Update, context: ContextTypes.DEFAUL
     context.user_data['awaiting_file_for'] = 'pdf_to_img'
     return AWAIT_PDF_TO_IMAGE_FILE
 
+def write_options_for(action: str, query) -> pdf_engine.WriteOptions:
+    # Кнопки "...и сжать для почты" уменьшают картинки; иначе — профиль действия из настроек
+    return pdf_engine.write_options(action, "email" if query and query.data.endswith("_email") else None)
+
+async def store_session_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE, document) -> str:
+    # С локальным Bot API сервером файл уже лежит на диске, иначе кладем копию во временное хранилище
+    source = await file_cache.get_source(context.bot, document)
+    local = isinstance(source, str)
+    file_path = source if local else await blob_store.put(update.effective_user.id, source)
+    context.user_data['pdf_file_path'], context.user_data['pdf_file_local'] = file_path, local
+    return file_path
+
+def session_pdf_path(context: ContextTypes.DEFAULT_TYPE) -> str | None:
+    # Файл локального Bot API сервера не учитывается в blob_store: он жив, пока лежит на диске
+    file_path = context.user_data.get('pdf_file_path')
+    if context.user_data.get('pdf_file_local'): return file_path if file_path and os.path.isfile(file_path) else None
+    return blob_store.get(file_path)
+
 async def ask_for_page_range(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     document = update.message.document
     try:
-        file = await context.bot.get_file(document.file_id)
-        file_bytes = await file.download_as_bytearray()
-        pdf_doc = fitz.open(stream=file_bytes, filetype="pdf")
+        # Пока пользователь думает над диапазоном, файл лежит на диске, а не в памяти
+        file_path = await store_session_pdf(update, context, document)
+        page_count = await pdf_engine.page_count(file_path)
         
-        context.user_data['pdf_file_bytes'] = file_bytes
-        context.user_data['pdf_page_count'] = pdf_doc.page_count
+        context.user_data['pdf_document'] = document  # ссылка на файл, если временный файл пропадет
+        context.user_data['pdf_page_count'] = page_count
         base_name = os.path.splitext(document.file_name)[0]
         context.user_data['pdf_base_name'] = base_name
 
         await update.message.reply_text(
-            f"Файл получен! В нем {pdf_doc.page_count} страниц.\n\nКакие страницы преобразовать? Отправь `все` или укажи номера/диапазоны (например: `1-3, 5`).",
+            f"Файл получен! В нем {page_count} страниц.\n\nКакие страницы преобразовать? Отправь `все` или укажи номера/диапазоны (например: `1-3, 5`).\n\n"
+            f"Можно добавить параметры: формат {IMAGE_FORMATS_HINT}, качество `q80`, разрешение `150dpi`, `ч/б`, "
+            "а также `zip` (одним архивом) или `альбом` (фотографиями). Например: `все jpg 150dpi zip`.",
             parse_mode='Markdown')
-        pdf_doc.close()
         return AWAIT_PAGE_RANGE_FOR_IMAGE
+    except SessionStoreFull as e:
+        logger.warning(f"Нет места для файла пользователя: {e}")
+        await update.message.reply_text("Файл слишком большой, сейчас я не могу его принять. Попробуйте позже или отправьте файл поменьше.")
+        return CHOOSE_ACTION
     except Exception as e:
         logger.error(f"Ошибка при чтении PDF для конвертации в картинки: {e}")
         await update.message.reply_text("Не удалось прочитать этот PDF. Возможно, он поврежден.")
         return CHOOSE_ACTION
 
 async def pdf_to_image_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    page_range_str = update.message.text
+    file_path = session_pdf_path(context)
+    if file_path is None and (document := context.user_data.get('pdf_document')):
+        # Файл остался на другом экземпляре бота или пропал при перезапуске — скачиваем заново
+        try:
+            with metrics.span("download") as span:
+                file_path = await store_session_pdf(update, context, document); span.size = metrics.source_size(file_path)
+        except SessionStoreFull as e:
+            logger.warning(f"Нет места для файла пользователя: {e}")
+            return await return_to_main_menu(update, context, message="Файл слишком большой, сейчас я не могу его принять. Попробуйте позже или отправьте файл поменьше.")
+        except Exception as e:
+            logger.error(f"Не удалось заново скачать PDF для конвертации в картинки: {e}")
+            return await return_to_main_menu(update, context, message="Не удалось заново получить файл. Пожалуйста, отправьте его еще раз.")
+    if file_path is None:
+        return await return_to_main_menu(update, context, message="Файл уже удален из-за долгого ожидания. Пожалуйста, отправьте его заново.")
+    parsed = parse_image_options(update.message.text)
     max_pages = context.user_data.get('pdf_page_count', 0)
-    page_indices = parse_page_ranges(page_range_str, max_pages)
+    page_indices = parse_page_ranges(parsed[0], max_pages) if parsed else []
     
+    if parsed is None and not pdf_engine.WEBP_AVAILABLE and 'webp' in update.message.text.lower().split():
+        await update.message.reply_text("Формат WebP сейчас недоступен. Выбери `png` или `jpg`.", parse_mode='Markdown')
+        return AWAIT_PAGE_RANGE_FOR_IMAGE
     if not page_indices:
         await update.message.reply_text("Не поняла диапазон. Попробуй еще раз. Например: `1-3, 5` или `все`.", parse_mode='Markdown')
         return AWAIT_PAGE_RANGE_FOR_IMAGE
@@ -180,23 +325,38 @@ async def pdf_to_image_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     await update.message.reply_text(f"Принято! Начинаю преобразование {len(page_indices)} страниц. Это может занять время...")
     
     try:
-        file_bytes = context.user_data.get('pdf_file_bytes')
         base_name = context.user_data.get('pdf_base_name', 'document')
-        pdf_doc = fitz.open(stream=file_bytes, filetype="pdf")
         
-        for page_index in page_indices:
-            page = pdf_doc.load_page(page_index)
-            pix = page.get_pixmap(dpi=200)
-            
-            # ИСПРАВЛЕНО: Генерируем байты и отправляем их напрямую, указывая filename
-            img_bytes = pix.tobytes("png")
-            
-            await context.bot.send_document(
-                chat_id=update.effective_chat.id,
-                document=img_bytes, # Отправляем байты напрямую
-                filename=f"{base_name}_page_{page_index + 1}.png" # Указываем имя файла
-            )
-        pdf_doc.close()
+        _, options, output = parsed; chat_id = update.effective_chat.id
+        with metrics.job("pdf_to_img", update.effective_user.id):
+            pages = pdf_engine.render_pages(file_path, page_indices, options)
+            # Рендер идет в пуле процессов с опережением, пока готовые страницы отправляются
+            if output == 'zip':
+                # Архив пишется во временный файл и уходит в Delivery путем, не загружаясь в память;
+                # без локального Bot API сервера Telegram не примет файл больше FILESIZE_UPLOAD
+                limit = None if context.bot.local_mode else FileSizeLimit.FILESIZE_UPLOAD
+                fd, zip_path = tempfile.mkstemp(prefix="pdf_bot_zip_", suffix=".zip")
+                try:
+                    with os.fdopen(fd, "wb") as zip_file, zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_STORED) as archive:
+                        async with aclosing(pages):
+                            async for page_index, img_bytes in pages:
+                                with metrics.span("serialize", size=len(img_bytes)):
+                                    await asyncio.to_thread(archive.writestr, f"{base_name}_page_{page_index + 1}.{options.extension}", img_bytes)
+                                if limit and zip_file.tell() > limit: break  # дальше рендерить бессмысленно
+                    if limit and os.path.getsize(zip_path) > limit:
+                        return await return_to_main_menu(update, context, message=(
+                            f"Архив получается больше {limit // 1_000_000} МБ, и Telegram его не примет. "
+                            "Попробуйте меньше страниц, формат jpg, меньшее разрешение или отправку без zip."))
+                    delivery = Delivery(context.bot, chat_id, total=1)
+                    await delivery.add(zip_path, f"{base_name}_pages.zip", remove=True); await delivery.finish()
+                finally:
+                    if os.path.exists(zip_path): os.remove(zip_path)
+            else:
+                delivery = Delivery(context.bot, chat_id, total=len(page_indices), as_photos=(output == 'album'))
+                async with aclosing(pages):
+                    async for page_index, img_bytes in pages:
+                        await delivery.add(img_bytes, f"{base_name}_page_{page_index + 1}.{options.extension}")
+                await delivery.finish()
         final_message = "Готово! Все страницы отправлены в виде картинок."
     except Exception as e:
         logger.error(f"Ошибка при конвертации PDF в картинки: {e}")
@@ -253,36 +413,35 @@ async def split_file_handler(update: Update, context: ContextTypes.DEFAULT_TYPE,
         await update.message.reply_text("Файл принят. Начинаю обработку...")
     final_message = "Готово! Все части файла отправлены."
     try:
-        file = await context.bot.get_file(document.file_id)
-        file_bytes = await file.download_as_bytearray()
-        pdf_doc = fitz.open(stream=file_bytes, filetype="pdf")
-        total_pages = pdf_doc.page_count; ranges, mode = [], context.user_data.get('split_mode')
-        if mode == 'split_single': ranges = [[i] for i in range(total_pages)]
-        elif mode == 'split_double':
-            ranges = [[i, i + 1] for i in range(0, total_pages, 2)]
-            if total_pages % 2 != 0: ranges[-1] = [total_pages - 1]
-        elif mode == 'split_custom':
-            order, current_page = context.user_data.get('custom_order', []), 0
-            for part_size in order:
-                if current_page >= total_pages: break
-                end_page = min(current_page + part_size, total_pages)
-                ranges.append(list(range(current_page, end_page)))
-                current_page = end_page
-        base_name = os.path.splitext(document.file_name)[0]
-        for i, page_range in enumerate(ranges):
-            new_doc = fitz.open()
-            new_doc.insert_pdf(pdf_doc, from_page=page_range[0], to_page=page_range[-1])
-            await context.bot.send_document(chat_id=update.effective_chat.id, document=new_doc.write(), filename=f"{base_name}_part_{i + 1}.pdf")
-            new_doc.close()
-        pdf_doc.close()
+        write_options = pdf_engine.write_options("split")
+        with metrics.job("split", update.effective_user.id, profile=write_options.name):
+            async with AsyncExitStack() as stack:
+                # Исходник — файл на диске: процессы пула читают его сами, а в памяти бота он не лежит
+                with metrics.span("download") as span:
+                    source_path = await stack.enter_async_context(file_cache.source_path(context.bot, document))
+                    span.size = metrics.source_size(source_path)
+                mode, custom_order = context.user_data.get('split_mode'), context.user_data.get('custom_order', [])
+                total_pages = await pdf_engine.page_count(source_path)
+                # Номер части должен пережить обрезку имени локальным сервером, поэтому укорачиваем само имя
+                base_name = safe_filename(os.path.splitext(document.file_name)[0], 150)
+                delivery = Delivery(context.bot, update.effective_chat.id, total=sum(1 for _ in pdf_engine.split_ranges(mode, total_pages, custom_order)))
+                # Части собираются в пуле и пишутся во временные файлы, пока готовые уже отправляются;
+                # локальному Bot API серверу они отдаются по пути, поэтому пишутся в его UPLOAD_DIR
+                if context.bot.local_mode: os.makedirs(UPLOAD_DIR, exist_ok=True)
+                part_dir = stack.enter_context(tempfile.TemporaryDirectory(prefix="pdf_bot_split_", dir=UPLOAD_DIR if context.bot.local_mode else None,
+                                                                           ignore_cleanup_errors=True))
+                ranges = pdf_engine.split_ranges(mode, total_pages, custom_order)
+                async with aclosing(pdf_engine.split_stream(source_path, ranges, part_dir, write_options)) as parts:
+                    async for number, part_path in parts: await delivery.add(part_path, f"{base_name}_part_{number}.pdf", remove=True)
+                await delivery.finish()
     except Exception as e:
         logger.error(f"Ошибка при разбивке PDF: {e}"); final_message = "К сожалению, при обработке файла произошла ошибка."
     return await return_to_main_menu(update, context, message=final_message)
 
 async def ask_for_combine_files(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query; await query.answer(); context.user_data.clear()
+    query = update.callback_query; await query.answer(); clear_session(update, context)
     context.user_data['files_to_process'] = []
-    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("✅ Все файлы отправлены", callback_data="process_done")], [InlineKeyboardButton("« Назад в главное меню", callback_data="main_menu")]])
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("✅ Все файлы отправлены", callback_data="process_done")], [InlineKeyboardButton("📧 Объединить и сжать для почты", callback_data="process_done_email")], [InlineKeyboardButton("« Назад в главное меню", callback_data="main_menu")]])
     await query.edit_message_text("Поняла. Отправляйте мне PDF файлы для объединения. Когда закончите, нажмите кнопку.", reply_markup=keyboard)
     context.user_data['awaiting_file_for'] = 'combine'
     return AWAIT_COMBINE_FILES
@@ -290,10 +449,19 @@ async def ask_for_combine_files(update: Update, context: ContextTypes.DEFAULT_TY
 async def receive_file_for_list(update: Update, context: ContextTypes.DEFAULT_TYPE, next_state: int):
     if 'files_to_process' not in context.user_data: context.user_data['files_to_process'] = []
     document = update.message.document; context.user_data['files_to_process'].append(document)
+    file_cache.prefetch(context.bot, document)  # Качаем сразу, не дожидаясь кнопки "Все файлы отправлены"
     context.user_data['awaiting_file_for'] = 'combine' if next_state == AWAIT_COMBINE_FILES else 'assembly_unique'
     await update.message.reply_text(f"Файл '{document.file_name}' добавлен ({len(context.user_data['files_to_process'])} всего).")
     return next_state
 
+async def take_premerged(update: Update, documents) -> str | None:
+    task = album_aggregator.take_premerge(update.effective_user.id, tuple(d.file_unique_id for d in documents))
+    if task is None: return None
+    try:
+        with metrics.span("premerge_wait"): return blob_store.get(await task)
+    except Exception as e:
+        logger.warning(f"Заготовка объединения альбома не удалась, объединяю заново: {e}"); return None
+
 async def combine_files_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, from_group: bool = False) -> int:
     query = update.callback_query; await query.answer()
     documents = context.user_data.get('group_files_to_process') if from_group else context.user_data.get('files_to_process', [])
@@ -305,26 +473,32 @@ async def combine_files_handler(update: Update, context: ContextTypes.DEFAULT_TY
     await query.edit_message_text("Отлично! Начинаю объединение...")
     final_message = "Готово! Ваш объединенный файл."
     try:
-        result_doc = fitz.open()
-        for doc in documents:
-            file = await context.bot.get_file(doc.file_id)
-            file_bytes = await file.download_as_bytearray()
-            pdf_doc = fitz.open(stream=file_bytes, filetype="pdf"); result_doc.insert_pdf(pdf_doc); pdf_doc.close()
-        await context.bot.send_document(chat_id=update.effective_chat.id, document=result_doc.write(), filename="combined_document.pdf")
-        result_doc.close()
+        write_options = write_options_for("combine", query)
+        with metrics.job("combine", update.effective_user.id, profile=write_options.name):
+            premerged = await take_premerged(update, documents) if from_group else None
+            if premerged is not None:
+                # Альбом уже объединен заранее, осталось записать результат с нужным профилем
+                result_bytes = await pdf_engine.merge([premerged], write_options)
+            else:
+                # Файлы качаются параллельно, а объединение начинается по мере их готовности
+                sources = metrics.timed_iter("download", file_cache.iter_ordered(context.bot, documents, as_source=True))
+                result_bytes = await pdf_engine.merge_stream(sources, write_options)
+            delivery = Delivery(context.bot, update.effective_chat.id, total=1)
+            await delivery.add(result_bytes, "combined_document.pdf"); await delivery.finish()
     except Exception as e:
         logger.error(f"Ошибка при объединении PDF: {e}"); final_message = "К сожалению, при обработке одного из файлов произошла ошибка."
     return await return_to_main_menu(update, context, message=final_message)
 
 async def ask_for_assembly_common_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query; await query.answer(); context.user_data.clear()
+    query = update.callback_query; await query.answer(); clear_session(update, context)
     await query.edit_message_text("Хорошо. Сначала отправьте мне ОДИН общий PDF файл.")
     context.user_data['awaiting_file_for'] = 'assembly_common'
     return AWAIT_ASSEMBLY_COMMON
 
 async def receive_assembly_common_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['common_file'] = update.message.document; context.user_data['files_to_process'] = []
-    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("✅ Собрать файлы", callback_data="process_done")], [InlineKeyboardButton("« Назад в главное меню", callback_data="main_menu")]])
+    file_cache.prefetch(context.bot, update.message.document)
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("✅ Собрать файлы", callback_data="process_done")], [InlineKeyboardButton("📧 Собрать и сжать для почты", callback_data="process_done_email")], [InlineKeyboardButton("« Назад в главное меню", callback_data="main_menu")]])
     await update.message.reply_text("Общий файл принят. Теперь отправляйте УНИКАЛЬНЫЕ PDF файлы.", reply_markup=keyboard)
     context.user_data['awaiting_file_for'] = 'assembly_unique'
     return AWAIT_ASSEMBLY_UNIQUE
@@ -340,28 +514,60 @@ async def assembly_files_handler(update: Update, context: ContextTypes.DEFAULT_T
     await query.edit_message_text("Все файлы получены. Начинаю сборку...")
     final_message = "Готово! Все файлы собраны и отправлены."
     try:
-        common_file = await context.bot.get_file(common_doc_msg.file_id)
-        common_file_bytes = await common_file.download_as_bytearray()
-        for doc in unique_docs:
-            unique_file = await context.bot.get_file(doc.file_id); unique_file_bytes = await unique_file.download_as_bytearray()
-            result_doc = fitz.open(stream=unique_file_bytes, filetype="pdf"); common_pdf = fitz.open(stream=common_file_bytes, filetype="pdf")
-            result_doc.insert_pdf(common_pdf); common_pdf.close()
-            await context.bot.send_document(chat_id=update.effective_chat.id, document=result_doc.write(), filename=f"assembled_{doc.file_name}")
-            result_doc.close()
+        write_options = write_options_for("assembly", query)
+        with metrics.job("assembly", update.effective_user.id, profile=write_options.name):
+            with metrics.span("download") as span:
+                common_source = await file_cache.get_source(context.bot, common_doc_msg); span.size = metrics.source_size(common_source)
+            # Общий файл разбирается один раз на процесс пула, сборки идут параллельно
+            unique_sources = metrics.timed_iter("download", file_cache.iter_ordered(context.bot, unique_docs, as_source=True))
+            async with aclosing(unique_sources) as unique_files, \
+                    aclosing(pdf_engine.assemble_many(common_source, unique_files, write_options)) as results:
+                delivery = Delivery(context.bot, update.effective_chat.id, total=len(unique_docs))
+                for doc in unique_docs:
+                    await delivery.add(await anext(results), f"assembled_{doc.file_name}")
+                await delivery.finish()
     except Exception as e:
         logger.error(f"Ошибка при сборке PDF: {e}"); final_message = "К сожалению, при обработке одного из файлов произошла ошибка."
     return await return_to_main_menu(update, context, message=final_message)
 
 
+# Telegram id администраторов через запятую: только им доступна /stats (без них команда отключена)
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if user_id}
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    cache_lines = [f"{key}: {value}" for key, value in file_cache.stats().items()]
+    session_lines = [f"{key}: {value}" for key, value in {**blob_store.stats(), **await media_group_files.stats(), **album_aggregator.stats()}.items()]
+    await update.message.reply_text("Кэш файлов:\n" + "\n".join(cache_lines) + "\n\nСессии:\n" + "\n".join(session_lines))
+
+async def sweep_sessions(context: ContextTypes.DEFAULT_TYPE) -> None:
+    blob_store.sweep(); await media_group_files.sweep(); album_aggregator.sweep()
+
+async def post_init(application: Application) -> None:
+    if pdf_engine.PDF_PREWARM: pdf_engine.start_prewarm()
+
+async def post_shutdown(application: Application) -> None:
+    pdf_engine.shutdown_executor()
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    metrics.ERRORS.inc(action="unhandled", stage="handler")
     logger.error(f"Update {update} caused error {context.error}", exc_info=context.error)
 
-def main():
-    TOKEN = os.getenv("TELEGRAM_TOKEN")
-    if not TOKEN: raise ValueError("Необходимо установить переменную окружения TELEGRAM_TOKEN")
-    application = Application.builder().token(TOKEN).build()
-
-    conv_handler = ConversationHandler(
+def build_application(token: str, request: BaseRequest | None = None) -> Application:
+    builder = Application.builder().token(token).post_init(post_init).post_shutdown(post_shutdown)
+    # Свой транспорт к Bot API (например, заглушка в бенчмарках)
+    if request is not None: builder = builder.request(request).get_updates_request(request)
+    # Локальный Bot API сервер: файлы до 2 ГБ, get_file отдает путь на диске, загрузка — по пути
+    BOT_API_URL = os.getenv("BOT_API_URL")
+    if BOT_API_URL:
+        builder = builder.base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot")
+        builder = builder.local_mode(os.getenv("BOT_API_LOCAL_MODE", "1") == "1")
+    # С общим хранилищем диалоги переживают перезапуск и могут обслуживаться несколькими экземплярами
+    if STATE_DB: builder = builder.persistence(BackendPersistence(backend))
+    # Разные чаты обрабатываются параллельно, сообщения одного чата — по порядку
+    if os.getenv("CONCURRENT_UPDATES", "1") == "1": builder = builder.concurrent_updates(ChatSerialUpdateProcessor())
+    application = builder.build()
+
+    conv_handler = SharedConversationHandler(
         entry_points=[
             CommandHandler("start", start),
             MessageHandler(filters.Document.PDF & filters.ChatType.PRIVATE, document_router),
@@ -380,31 +586,47 @@ def main():
             AWAIT_SPLIT_FILE: [MessageHandler(filters.Document.PDF, document_router)],
             AWAIT_COMBINE_FILES: [
                 MessageHandler(filters.Document.PDF, document_router),
-                CallbackQueryHandler(combine_files_handler, pattern="^process_done$"),
+                CallbackQueryHandler(combine_files_handler, pattern="^process_done(_email)?$"),
             ],
             AWAIT_ASSEMBLY_COMMON: [MessageHandler(filters.Document.PDF, document_router)],
             AWAIT_ASSEMBLY_UNIQUE: [
                 MessageHandler(filters.Document.PDF, document_router),
-                CallbackQueryHandler(assembly_files_handler, pattern="^process_done$"),
+                CallbackQueryHandler(assembly_files_handler, pattern="^process_done(_email)?$"),
             ],
             AWAIT_PDF_TO_IMAGE_FILE: [MessageHandler(filters.Document.PDF, document_router)],
             AWAIT_PAGE_RANGE_FOR_IMAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, pdf_to_image_handler)],
         },
         fallbacks=[CommandHandler("start", start), CallbackQueryHandler(main_menu, pattern="^main_menu$")],
-        allow_reentry=True
+        allow_reentry=True,
+        name="pdf_dialog", persistent=bool(STATE_DB),
     )
     
-    application.add_handler(CallbackQueryHandler(lambda u, c: combine_files_handler(u, c, from_group=True), pattern="^group_combine$"))
+    application.add_handler(CallbackQueryHandler(lambda u, c: combine_files_handler(u, c, from_group=True), pattern="^group_combine(_email)?$"))
+    if ADMIN_IDS: application.add_handler(CommandHandler("stats", stats, filters=filters.User(user_id=ADMIN_IDS)))
     application.add_handler(conv_handler)
+    # Состояние диалога подтягивается из хранилища до того, как диалог проверит обновление
+    if STATE_DB: application.add_handler(conv_handler.state_refresh_handler(), group=-1)
     application.add_error_handler(error_handler)
+    application.job_queue.run_repeating(sweep_sessions, interval=60, first=60)
+    if isinstance(application.update_processor, ChatSerialUpdateProcessor):
+        metrics.Gauge("pdf_bot_updates_waiting", "Обновлений ждут свободного слота", lambda: application.update_processor.queue_length)
+    metrics.Gauge("pdf_bot_album_delay_seconds", "Текущее окно ожидания файлов альбома", lambda: album_aggregator.delay)
+    metrics.Gauge("pdf_bot_session_bytes", "Байт в хранилище незавершенных сессий", lambda: blob_store.bytes_held)
+    metrics.Gauge("pdf_bot_cache_disk_bytes", "Байт в дисковом кэше файлов", lambda: file_cache.stats()["disk_bytes"])
+    if STATE_DB: application.job_queue.run_repeating(flush_due_media_groups, interval=1, first=1)
+    return application
+
+def main():
+    TOKEN = os.getenv("TELEGRAM_TOKEN")
+    if not TOKEN: raise ValueError("Необходимо установить переменную окружения TELEGRAM_TOKEN")
 
     WEBHOOK_URL = os.getenv("RENDER_EXTERNAL_URL")
     if WEBHOOK_URL:
-        port = int(os.environ.get('PORT', '8443'))
-        application.run_webhook(listen="0.0.0.0", port=port, url_path=TOKEN, webhook_url=f"{WEBHOOK_URL}/{TOKEN}")
+        # Свой сервер вместо application.run_webhook: рядом с вебхуком отдается /metrics
+        run_webhook_mode(TOKEN, WEBHOOK_URL)
     else:
         logger.info("Запуск в режиме polling...")
-        application.run_polling()
+        build_application(TOKEN).run_polling()
 
 if __name__ == "__main__":
     main()
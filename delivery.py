@@ -0,0 +1,192 @@
+import os
+import time
+import asyncio
+import uuid
+import shutil
+import logging
+import tempfile
+from pathlib import Path
+from telegram import InputMediaDocument, InputMediaPhoto
+from telegram.error import RetryAfter, TimedOut, NetworkError, BadRequest
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки отправки ---
+# Лимиты Telegram: ~30 сообщений/сек на бота и ~1 сообщение/сек в один чат (короткие всплески допустимы)
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_RETRIES = int(os.getenv("SEND_RETRIES", "5"))
+MEDIA_GROUP_SIZE = 10  # максимум Telegram для send_media_group
+# Куда складывать файлы для загрузки через локальный Bot API сервер (он должен видеть этот каталог)
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", os.path.join(tempfile.gettempdir(), "pdf_bot_uploads"))
+PROGRESS_INTERVAL = float(os.getenv("SEND_PROGRESS_INTERVAL", "5"))  # как часто обновлять сообщение о прогрессе
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate, self.capacity = rate, capacity
+        self._tokens, self._updated = capacity, time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """Полная остановка корзины, например, после RetryAfter от Telegram."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = min(self._tokens, 0)
+
+    async def acquire(self, tokens: float = 1) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now); continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate); self._updated = now
+                # Запрос дороже емкости корзины ждет полной корзины и уводит ее в минус
+                if self._tokens >= min(tokens, self.capacity):
+                    self._tokens -= tokens; return
+                await asyncio.sleep((min(tokens, self.capacity) - self._tokens) / self.rate)
+
+    @property
+    def idle(self) -> bool:
+        return self._tokens >= self.capacity and not self._lock.locked()
+
+
+class RateLimiter:
+    """Глобальная корзина на бота + отдельная корзина на каждый чат."""
+
+    def __init__(self, global_rate: float = SEND_GLOBAL_RATE, chat_rate: float = SEND_CHAT_RATE, chat_burst: int = SEND_CHAT_BURST):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate, self.chat_burst = chat_rate, chat_burst
+        self._chat_buckets: dict[int, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 1000:
+                for key in [k for k, b in self._chat_buckets.items() if b.idle]: del self._chat_buckets[key]
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def acquire(self, chat_id: int, messages: int = 1) -> None:
+        # Альбом — один запрос в чат, но глобально считаем каждое сообщение в нем
+        await self._chat_bucket(chat_id).acquire(1)
+        await self.global_bucket.acquire(messages)
+
+    def retry_after(self, chat_id: int, seconds: float) -> None:
+        self._chat_bucket(chat_id).pause(seconds)
+
+
+limiter = RateLimiter()
+
+
+async def send_with_retry(func, /, *args, messages: int = 1, **kwargs):
+    """Вызывает метод Bot API с учетом лимитов: ждет RetryAfter и повторяет при сетевых сбоях.
+    chat_id берется из именованных аргументов вызова."""
+    chat_id = kwargs["chat_id"]
+    for attempt in range(SEND_RETRIES + 1):
+        await limiter.acquire(chat_id, messages)
+        try: return await func(*args, **kwargs)
+        except RetryAfter as e:
+            if attempt == SEND_RETRIES: raise
+            logger.warning(f"Flood control в чате {chat_id}: ждем {e.retry_after} с")
+            limiter.retry_after(chat_id, e.retry_after)
+        except BadRequest: raise
+        except (TimedOut, NetworkError) as e:
+            if attempt == SEND_RETRIES: raise
+            logger.warning(f"Сетевая ошибка при отправке в чат {chat_id} ({e}), повтор #{attempt + 1}")
+            await asyncio.sleep(min(2 ** attempt, 30))
+
+
+class Delivery:
+    """Отправка результатов одной задачи: документы копятся и уходят альбомами по 10,
+    а прогресс показывается одним сообщением, которое редактируется на месте."""
+
+    def __init__(self, bot, chat_id: int, total: int = 0, as_photos: bool = False, progress_label: str = "Отправляю"):
+        self.bot, self.chat_id, self.total, self.as_photos, self.progress_label = bot, chat_id, total, as_photos, progress_label
+        self.sent = 0
+        self._batch: list[tuple[bytes | str, str]] = []
+        self._owned: list[str] = []  # готовые файлы, которые удаляются после отправки
+        self._progress_message = None
+        self._progress_updated = 0.0
+
+    async def _prepare(self, data: bytes | str, filename: str, spilled: list[Path]) -> bytes | Path:
+        if isinstance(data, str):
+            # InputMedia* превращает путь в file://, который понимает только локальный сервер, — читаем файл
+            if not self.bot.local_mode: return await asyncio.to_thread(Path(data).read_bytes)
+            if os.path.basename(data) == filename: return Path(data)
+        elif not self.bot.local_mode: return data
+        # Локальный сервер читает файл сам по пути (file://), а имя файла берет из пути
+        path = Path(UPLOAD_DIR) / uuid.uuid4().hex / safe_filename(filename)
+        await asyncio.to_thread(_link_upload if isinstance(data, str) else _write_upload, path, data)
+        spilled.append(path)
+        return path
+
+    async def add(self, data: bytes | str, filename: str, remove: bool = False) -> None:
+        """data — содержимое файла или путь к уже готовому файлу на диске;
+        remove=True — файл по этому пути временный и удаляется сразу после отправки."""
+        self._batch.append((data, filename))
+        if remove: self._owned.append(data)
+        if len(self._batch) >= MEDIA_GROUP_SIZE: await self.flush()
+
+    async def flush(self) -> None:
+        batch, self._batch = self._batch, []
+        if not batch: return
+        spilled: list[Path] = []
+        owned, self._owned = self._owned, []
+        try:
+            with metrics.span("upload", size=sum(metrics.source_size(data) for data, _ in batch)):
+                await self._send([(await self._prepare(data, filename, spilled), filename) for data, filename in batch])
+        finally:
+            for path in spilled: shutil.rmtree(path.parent, ignore_errors=True)
+            for path in owned:
+                try: os.remove(path)
+                except FileNotFoundError: pass
+        self.sent += len(batch)
+        await self._report_progress()
+
+    async def _send(self, batch: list[tuple[bytes | Path, str]]) -> None:
+        if len(batch) == 1:
+            data, filename = batch[0]
+            if self.as_photos: await send_with_retry(self.bot.send_photo, chat_id=self.chat_id, photo=data)
+            else: await send_with_retry(self.bot.send_document, chat_id=self.chat_id, document=data, filename=filename)
+        else:
+            if self.as_photos: media = [InputMediaPhoto(media=data, filename=filename) for data, filename in batch]
+            else: media = [InputMediaDocument(media=data, filename=filename) for data, filename in batch]
+            await send_with_retry(self.bot.send_media_group, chat_id=self.chat_id, media=media, messages=len(media))
+
+    async def _report_progress(self, force: bool = False) -> None:
+        if self.total <= MEDIA_GROUP_SIZE: return  # для маленьких задач прогресс не нужен
+        now = time.monotonic()
+        if not force and now - self._progress_updated < PROGRESS_INTERVAL: return
+        self._progress_updated = now
+        text = f"{self.progress_label}: {self.sent} из {self.total}"
+        try:
+            if self._progress_message is None:
+                self._progress_message = await send_with_retry(self.bot.send_message, chat_id=self.chat_id, text=text)
+            else:
+                await send_with_retry(self.bot.edit_message_text, chat_id=self.chat_id, message_id=self._progress_message.message_id, text=text)
+        except BadRequest as e:
+            # "Message is not modified" и подобное не должно ронять отправку
+            logger.debug(f"Не удалось обновить прогресс: {e}")
+
+    async def finish(self) -> None:
+        await self.flush()
+        if self._progress_message is not None: await self._report_progress(force=True)
+
+
+def safe_filename(filename: str, limit: int = 200) -> str:
+    """Имя для файла на диске: не длиннее limit байт в UTF-8 (у ФС предел 255), расширение сохраняется."""
+    stem, ext = os.path.splitext(os.path.basename(filename))
+    stem = stem.encode()[:max(limit - len(ext.encode()), 1)].decode(errors="ignore")
+    return (stem or "file") + ext
+
+def _write_upload(path: Path, data: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+def _link_upload(path: Path, src: str) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try: os.link(src, path)
+    except OSError: shutil.copyfile(src, path)
@@ -0,0 +1,241 @@
+import os
+import time
+import shutil
+import asyncio
+import logging
+import tempfile
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки кэша ---
+CACHE_DIR = os.getenv("FILE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "pdf_bot_cache"))
+CACHE_MAX_BYTES = int(os.getenv("FILE_CACHE_MAX_MB", "512")) * 1024 * 1024
+CACHE_MEMORY_MAX_BYTES = int(os.getenv("FILE_CACHE_MEMORY_MB", "64")) * 1024 * 1024  # 0 — без кэша в памяти
+CACHE_TTL = int(os.getenv("FILE_CACHE_TTL", "3600"))  # секунды
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "4"))  # одновременных загрузок на процесс
+
+
+@dataclass
+class _Entry:
+    path: str
+    size: int
+    stored_at: float
+
+
+class FileCache:
+    """Кэш скачанных файлов Telegram по file_unique_id: диск + (опционально) память, LRU + TTL."""
+
+    def __init__(self, cache_dir: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES,
+                 memory_max_bytes: int = CACHE_MEMORY_MAX_BYTES, ttl: float = CACHE_TTL,
+                 download_concurrency: int = DOWNLOAD_CONCURRENCY):
+        self.download_concurrency = download_concurrency
+        self._download_slots: asyncio.Semaphore | None = None
+        self._prefetch_tasks: set[asyncio.Task] = set()
+        self.cache_dir, self.max_bytes, self.memory_max_bytes, self.ttl = cache_dir, max_bytes, memory_max_bytes, ttl
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._disk_bytes = self._memory_bytes = 0
+        self._inflight: dict[str, asyncio.Future] = {}
+        self.hits = self.memory_hits = self.misses = self.evictions = 0
+        self.bytes_downloaded = self.bytes_saved = 0
+        self.local_paths = 0
+        self._load_index()
+
+    def _load_index(self) -> None:
+        # Файлы с прошлого запуска тоже считаются кэшем
+        os.makedirs(self.cache_dir, exist_ok=True)
+        found = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                if name.endswith(".tmp"):
+                    # Недописанный файл упавшего процесса; каталог могут делить живые процессы бота
+                    if _is_stale_tmp(path): os.remove(path)
+                    continue
+                stat = os.stat(path)
+            except FileNotFoundError: continue  # его успел убрать другой процесс
+            found.append((stat.st_mtime, name, path, stat.st_size))
+        for mtime, name, path, size in sorted(found):
+            self._entries[name] = _Entry(path, size, mtime); self._disk_bytes += size
+        self._evict()
+
+    def _is_expired(self, entry: _Entry) -> bool:
+        return self.ttl > 0 and time.time() - entry.stored_at > self.ttl
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._disk_bytes -= entry.size; self.evictions += 1
+            try: os.remove(entry.path)
+            except FileNotFoundError: pass
+        data = self._memory.pop(key, None)
+        if data is not None: self._memory_bytes -= len(data)
+
+    def _evict(self) -> None:
+        for key in [k for k, e in self._entries.items() if self._is_expired(e)]: self._drop(key)
+        while self._disk_bytes > self.max_bytes and self._entries: self._drop(next(iter(self._entries)))
+        while self._memory_bytes > self.memory_max_bytes and self._memory:
+            _, data = self._memory.popitem(last=False); self._memory_bytes -= len(data)
+
+    def _remember(self, key: str, data: bytes) -> None:
+        if self.memory_max_bytes <= 0 or len(data) > self.memory_max_bytes: return
+        old = self._memory.pop(key, None)
+        if old is not None: self._memory_bytes -= len(old)
+        self._memory[key] = data; self._memory_bytes += len(data)
+
+    async def _lookup(self, key: str) -> bytes | None:
+        entry = self._entries.get(key)
+        if entry is None: return None
+        if self._is_expired(entry):
+            self._drop(key); return None
+        self._entries.move_to_end(key)
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key); self.memory_hits += 1
+            return data
+        try: data = await asyncio.to_thread(_read_file, entry.path)
+        except FileNotFoundError:
+            self._drop(key); return None
+        self._remember(key, data); self._evict()
+        return data
+
+    async def _download(self, bot, document) -> bytes:
+        # Семафор создается лениво, чтобы привязаться к работающему циклу событий
+        if self._download_slots is None: self._download_slots = asyncio.Semaphore(self.download_concurrency)
+        async with self._download_slots:
+            started = time.perf_counter()
+            file = await bot.get_file(document.file_id)
+            data = bytes(await file.download_as_bytearray())
+            metrics.DOWNLOAD_SECONDS.observe(time.perf_counter() - started)
+        key = document.file_unique_id; path = os.path.join(self.cache_dir, key)
+        await asyncio.to_thread(_write_file, path, data)
+        self._drop(key)
+        self._entries[key] = _Entry(path, len(data), time.time()); self._disk_bytes += len(data)
+        self._remember(key, data); self._evict()
+        self.bytes_downloaded += len(data)
+        return data
+
+    async def get(self, bot, document) -> bytes:
+        """Возвращает содержимое документа, скачивая его не больше одного раза."""
+        key = document.file_unique_id
+        data = await self._lookup(key)
+        if data is not None:
+            self.hits += 1; self.bytes_saved += len(data); metrics.CACHE_REQUESTS.inc(result="hit")
+            return data
+        # Single-flight: параллельные запросы одного файла ждут одну загрузку
+        future = self._inflight.get(key)
+        if future is not None:
+            self.hits += 1; metrics.CACHE_REQUESTS.inc(result="inflight")
+            data = await asyncio.shield(future); self.bytes_saved += len(data)
+            return data
+        self.misses += 1; metrics.CACHE_REQUESTS.inc(result="miss")
+        future = asyncio.ensure_future(self._download(bot, document))
+        self._inflight[key] = future
+        future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def get_source(self, bot, document) -> bytes | str:
+        """Источник для движка PDF: с локальным Bot API сервером — путь к файлу на его диске
+        (без HTTP-копии и без буфера в памяти), иначе — содержимое из кэша."""
+        if bot.local_mode:
+            file = await bot.get_file(document.file_id)
+            if file.file_path and os.path.isfile(file.file_path):
+                self.local_paths += 1; metrics.CACHE_REQUESTS.inc(result="local")
+                return file.file_path
+        return await self.get(bot, document)
+
+    @asynccontextmanager
+    async def source_path(self, bot, document):
+        """Путь к файлу документа на время задачи, без содержимого в памяти обработчика.
+        Файл кэша берется жесткой ссылкой, чтобы его вытеснение не задело задачу; если
+        файла в кэше нет (например, он больше всего кэша), содержимое пишется во временный файл."""
+        data = None
+        if bot.local_mode:
+            data = await self.get_source(bot, document)
+            if isinstance(data, str):
+                yield data; return
+        key = document.file_unique_id
+        entry = self._entries.get(key)
+        if data is None:
+            if entry is not None and not self._is_expired(entry) and os.path.isfile(entry.path):
+                # Попадание в кэш: файл не читается в память, а сразу отдается ссылкой
+                self._entries.move_to_end(key)
+                self.hits += 1; self.bytes_saved += entry.size; metrics.CACHE_REQUESTS.inc(result="hit")
+            else:
+                data = await self.get(bot, document); entry = self._entries.get(key)
+        tmp_dir = tempfile.mkdtemp(prefix="pdf_bot_source_")
+        path = os.path.join(tmp_dir, "source.pdf")
+        try:
+            try:
+                if entry is None: raise FileNotFoundError(key)
+                os.link(entry.path, path)
+            except OSError:
+                if data is None: data = await self.get(bot, document)
+                await asyncio.to_thread(_write_file, path, data)
+            del data
+            yield path
+        finally: shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def prefetch(self, bot, document) -> None:
+        """Запускает фоновую загрузку файла, как только он принят от пользователя."""
+        if bot.local_mode: return  # файл и так уже лежит на диске сервера
+        async def _prefetch():
+            try: await self.get(bot, document)
+            except Exception as e: logger.warning(f"Не удалось заранее скачать файл {document.file_unique_id}: {e}")
+        task = asyncio.create_task(_prefetch())
+        self._prefetch_tasks.add(task); task.add_done_callback(self._prefetch_tasks.discard)
+
+    async def iter_ordered(self, bot, documents, as_source: bool = False, ahead: int | None = None):
+        """Качает документы параллельно (с ограничением), но отдает их строго в исходном порядке.
+        Вперед потребителя качается не больше ahead документов (по умолчанию — download_concurrency),
+        чтобы скачанные, но еще не нужные файлы не копились в памяти. С as_source=True отдает то же, что get_source."""
+        fetch = self.get_source if as_source else self.get
+        documents, ahead, pending = iter(documents), ahead or self.download_concurrency, deque()
+        def fill():
+            for doc in documents:
+                pending.append(asyncio.ensure_future(fetch(bot, doc)))
+                if len(pending) >= ahead: break
+        try:
+            fill()
+            while pending:
+                data = await pending[0]; pending.popleft(); fill()
+                yield data
+        finally:
+            for task in pending: task.cancel()
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits, "memory_hits": self.memory_hits, "misses": self.misses,
+            "hit_rate": round(self.hits / requests, 3) if requests else 0.0,
+            "evictions": self.evictions, "entries": len(self._entries),
+            "disk_bytes": self._disk_bytes, "memory_bytes": self._memory_bytes,
+            "bytes_downloaded": self.bytes_downloaded, "bytes_saved": self.bytes_saved,
+            "local_paths": self.local_paths,
+        }
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f: return f.read()
+
+def _is_stale_tmp(path: str, max_age: float = 3600) -> bool:
+    """Временный файл <ключ>.<pid>.tmp брошен, если его процесса уже нет или он пишется подозрительно долго."""
+    if time.time() - os.path.getmtime(path) > max_age: return True
+    try: os.kill(int(path.rsplit(".", 2)[-2]), 0)
+    except ValueError: return True
+    except ProcessLookupError: return True
+    except PermissionError: pass  # процесс есть, но чужой
+    return False
+
+def _write_file(path: str, data: bytes) -> None:
+    # Пишем во временный файл и переименовываем, чтобы не оставить обрезанный файл
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f: f.write(data)
+    os.replace(tmp_path, path)
+
+
+file_cache = FileCache()
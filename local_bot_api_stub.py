@@ -0,0 +1,142 @@
+"""Заглушка локального Telegram Bot API сервера для проверки режима BOT_API_URL без Telegram.
+
+Файлы для бота берутся из каталога: file_id — это имя файла в нем. Все, что бот отправляет,
+складывается в каталог sent/. Запуск:
+
+    python local_bot_api_stub.py --dir ./files --port 8081
+    BOT_API_URL=http://127.0.0.1:8081 TELEGRAM_TOKEN=1:stub python bot.py
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import itertools
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, unquote, urlparse
+
+
+class BotApiStub:
+    """Ответы на методы Bot API без сети. Используется и HTTP-сервером ниже, и бенчмарками."""
+
+    def __init__(self, files_dir: str, sent_dir: str | None = None, local_mode: bool = True):
+        self.files_dir, self.local_mode = os.path.abspath(files_dir), local_mode
+        self.sent_dir = os.path.abspath(sent_dir or os.path.join(files_dir, "sent"))
+        os.makedirs(self.sent_dir, exist_ok=True)
+        self.sent: list[dict] = []  # журнал отправленного: метод, чат, имя и размер файла
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def file_path(self, file_id: str) -> str | None:
+        path = os.path.join(self.files_dir, os.path.basename(file_id))
+        return path if os.path.isfile(path) else None
+
+    def _message(self, chat_id, **extra) -> dict:
+        return {"message_id": next(self._message_ids), "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": "private"}, **extra}
+
+    def _store(self, method: str, chat_id, value: str, files: dict[str, tuple[str, bytes]], filename: str | None = None) -> dict:
+        """Сохраняет отправленный файл: file:// (локальный режим), attach:// или сам файл в multipart."""
+        if value.startswith("file://"):
+            src = unquote(urlparse(value).path); filename = os.path.basename(src)
+            data_size = os.path.getsize(src); shutil.copy(src, os.path.join(self.sent_dir, filename))
+        else:
+            name = value[len("attach://"):] if value.startswith("attach://") else value
+            filename, data = files.get(name, (filename or name, b""))
+            data_size = len(data)
+            with open(os.path.join(self.sent_dir, os.path.basename(filename)), "wb") as f: f.write(data)
+        record = {"method": method, "chat_id": int(chat_id), "filename": filename, "size": data_size}
+        with self._lock: self.sent.append(record)
+        return {"file_id": filename, "file_unique_id": filename, "file_name": filename, "file_size": data_size}
+
+    def handle(self, method: str, params: dict, files: dict[str, tuple[str, bytes]]):
+        """Возвращает result метода или бросает ValueError с описанием ошибки."""
+        chat_id = params.get("chat_id", 0)
+        if method == "getMe": return {"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub_bot"}
+        if method == "getUpdates":
+            time.sleep(min(float(params.get("timeout", 0)), 1)); return []
+        if method == "getFile":
+            path = self.file_path(params["file_id"])
+            if path is None: raise ValueError("Bad Request: file not found")
+            name = os.path.basename(path)
+            return {"file_id": name, "file_unique_id": name, "file_size": os.path.getsize(path),
+                    "file_path": path if self.local_mode else name}
+        if method in ("sendMessage", "editMessageText"):
+            with self._lock: self.sent.append({"method": method, "chat_id": int(chat_id), "text": params.get("text")})
+            return self._message(chat_id, text=params.get("text", ""))
+        if method in ("sendDocument", "sendPhoto"):
+            field = "document" if method == "sendDocument" else "photo"
+            value = params.get(field) or f"attach://{field}"
+            return self._message(chat_id, document=self._store(method, chat_id, value, files))
+        if method == "sendMediaGroup":
+            media = json.loads(params["media"])
+            return [self._message(chat_id, media_group_id="1", document=self._store(method, chat_id, item["media"], files))
+                    for item in media]
+        return True
+
+
+def _parse_body(content_type: str, body: bytes) -> tuple[dict, dict[str, tuple[str, bytes]]]:
+    params, files = {}, {}
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename() is not None: files[name] = (part.get_filename(), part.get_payload(decode=True))
+            else: params[name] = part.get_payload(decode=True).decode()
+    elif content_type.startswith("application/json"):
+        params = json.loads(body or b"{}")
+    else:
+        params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+    return params, files
+
+
+def make_handler(stub: BotApiStub):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, payload: dict) -> None:
+            body = json.dumps(payload).encode()
+            self.send_response(status); self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body))); self.end_headers(); self.wfile.write(body)
+
+        def do_POST(self):
+            # /bot<token>/<method>
+            method = self.path.rstrip("/").rsplit("/", 1)[-1]
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            params, files = _parse_body(self.headers.get("Content-Type", ""), body)
+            try: self._reply(200, {"ok": True, "result": stub.handle(method, params, files)})
+            except ValueError as e: self._reply(400, {"ok": False, "error_code": 400, "description": str(e)})
+
+        def do_GET(self):
+            # /file/bot<token>/<file_path> — скачивание, когда заглушка запущена не в локальном режиме
+            path = stub.file_path(unquote(self.path.rsplit("/", 1)[-1]))
+            if path is None:
+                self.send_response(404); self.end_headers(); return
+            with open(path, "rb") as f: data = f.read()
+            self.send_response(200); self.send_header("Content-Length", str(len(data))); self.end_headers(); self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(stub: BotApiStub, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """Запускает заглушку в фоновом потоке; адрес — server.server_address."""
+    server = ThreadingHTTPServer((host, port), make_handler(stub))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка локального Telegram Bot API сервера")
+    parser.add_argument("--dir", required=True, help="каталог с файлами, которые будет видеть бот")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--remote", action="store_true", help="отдавать файлы по HTTP, как обычный api.telegram.org")
+    args = parser.parse_args()
+    server = serve(BotApiStub(args.dir, local_mode=not args.remote), args.host, args.port)
+    print(f"Заглушка Bot API слушает http://{args.host}:{server.server_address[1]}, файлы из {args.dir}")
+    try: threading.Event().wait()
+    except KeyboardInterrupt: server.shutdown()
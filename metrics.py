@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import secrets
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+# --- Телеметрия задач ---
+# Соль для хэша user_id в логах и метриках, чтобы по ним нельзя было восстановить пользователя.
+# Без нее хэши нельзя сопоставить между перезапусками и экземплярами, но и перебрать id тоже нельзя
+METRICS_USER_SALT = os.getenv("METRICS_USER_SALT") or secrets.token_hex(16)
+if not os.getenv("METRICS_USER_SALT"):
+    logger.warning("METRICS_USER_SALT не задан: хэши пользователей в логах будут меняться при каждом перезапуске")
+# JOB_LOG=0 — не писать в лог JSON-строку по каждой задаче (метрики /metrics при этом остаются)
+JOB_LOG = os.getenv("JOB_LOG", "1") == "1"
+# Границы гистограмм времени, секунды
+TIME_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Границы гистограмм размера, байты: от 64 КБ до 2 ГБ
+SIZE_BUCKETS = tuple(64 * 1024 * 4 ** i for i in range(8)) + (2 * 1024 ** 3,)
+
+
+# --- Метрики в формате Prometheus (без внешних зависимостей) ---
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra: pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+_registry: dict[str, "Counter | Histogram | Gauge"] = {}
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.label_names = name, help, labels
+        self._values: dict[tuple, float] = {}
+        _registry[name] = self
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels(self.label_names, key)} {value}" for key, value in self._values.items()]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = TIME_BUCKETS):
+        self.name, self.help, self.label_names, self.buckets = name, help, labels, buckets
+        self._values: dict[tuple, list] = {}  # метки -> [счетчики по корзинам..., сумма, количество]
+        _registry[name] = self
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        row = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound: row[i] += 1
+        row[-2] += value; row[-1] += 1
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, row in self._values.items():
+            for bound, count in zip(self.buckets, row):
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {count}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {row[-1]}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {round(row[-2], 6)}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {row[-1]}")
+        return lines
+
+
+class Gauge:
+    """Значение считывается в момент запроса /metrics (длина очереди, занятый диск и т. п.)."""
+
+    def __init__(self, name: str, help: str, func):
+        self.name, self.help, self.func = name, help, func
+        _registry[name] = self
+
+    def collect(self) -> list[str]:
+        try: value = self.func()
+        except Exception as e:
+            logger.warning(f"Не удалось снять метрику {self.name}: {e}"); return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus."""
+    return "\n".join(line for metric in _registry.values() for line in metric.collect()) + "\n"
+
+
+JOB_SECONDS = Histogram("pdf_bot_job_seconds", "Длительность задачи целиком", ("action",))
+STAGE_SECONDS = Histogram("pdf_bot_stage_seconds", "Время стадии задачи (работа в пуле суммируется по процессам)", ("action", "stage"))
+STAGE_BYTES = Counter("pdf_bot_stage_bytes_total", "Байт обработано на стадии", ("action", "stage"))
+STAGE_PAGES = Counter("pdf_bot_stage_pages_total", "Страниц обработано на стадии", ("action", "stage"))
+JOBS = Counter("pdf_bot_jobs_total", "Завершенные задачи", ("action", "status"))
+ERRORS = Counter("pdf_bot_errors_total", "Ошибки по задачам и стадиям", ("action", "stage"))
+CACHE_REQUESTS = Counter("pdf_bot_cache_requests_total", "Обращения к кэшу файлов", ("result",))
+DOWNLOAD_SECONDS = Histogram("pdf_bot_download_seconds", "Скачивание одного файла из Telegram")
+QUEUE_WAIT_SECONDS = Histogram("pdf_bot_queue_wait_seconds", "Ожидание обновления в очереди до начала обработки")
+# Для подбора профилей записи: сколько весит результат задачи и сколько стоило его записать
+OUTPUT_BYTES = Histogram("pdf_bot_output_bytes", "Размер результатов задачи", ("action", "profile"), buckets=SIZE_BUCKETS)
+WRITE_SECONDS = Histogram("pdf_bot_write_seconds", "Запись и оптимизация результатов задачи", ("action", "profile"))
+
+
+# --- Задачи и их стадии ---
+@dataclass
+class Span:
+    stage: str
+    size: int = 0  # байты
+    pages: int = 0
+
+
+@dataclass
+class Job:
+    action: str
+    user: str  # хэш user_id
+    started: float = field(default_factory=time.perf_counter)
+    stages: dict[str, dict] = field(default_factory=dict)
+    failed_stage: str | None = None
+    profile: str = ""  # профиль записи PDF, если задача его пишет
+
+    def add(self, stage: str, seconds: float, size: int = 0, pages: int = 0, count: int = 1) -> None:
+        # Стадия, встретившаяся несколько раз (например, части при разбивке), суммируется
+        totals = self.stages.setdefault(stage, {"seconds": 0.0, "size": 0, "pages": 0, "count": 0})
+        totals["seconds"] += seconds; totals["size"] += size; totals["pages"] += pages; totals["count"] += count
+
+
+_current_job: ContextVar[Job | None] = ContextVar("current_job", default=None)
+_queue_wait: ContextVar[float | None] = ContextVar("queue_wait", default=None)
+
+
+def hash_user(user_id: int | None) -> str:
+    return hashlib.sha256(f"{METRICS_USER_SALT}:{user_id}".encode()).hexdigest()[:12]
+
+def source_size(src: bytes | str) -> int:
+    """Размер источника PDF: байты или путь к файлу."""
+    return os.path.getsize(src) if isinstance(src, str) else len(src)
+
+def set_queue_wait(seconds: float) -> None:
+    """Вызывается обработчиком очереди перед запуском обновления; задача подхватит значение как стадию queue_wait."""
+    _queue_wait.set(seconds); QUEUE_WAIT_SECONDS.observe(seconds)
+
+
+@contextmanager
+def job(action: str, user_id: int | None, profile: str = ""):
+    """Задача пользователя: стадии внутри нее собираются, а по завершении попадают в метрики и в лог."""
+    current = Job(action, hash_user(user_id), profile=profile)
+    token = _current_job.set(current)
+    if (wait := _queue_wait.get()) is not None: current.add("queue_wait", wait)
+    status = "ok"
+    try: yield current
+    except BaseException:
+        status = "error"; ERRORS.inc(action=action, stage=current.failed_stage or "job")
+        raise
+    finally:
+        _current_job.reset(token)
+        _report(current, time.perf_counter() - current.started, status)
+
+def _report(current: Job, duration: float, status: str) -> None:
+    JOB_SECONDS.observe(duration, action=current.action); JOBS.inc(action=current.action, status=status)
+    for stage, totals in current.stages.items():
+        STAGE_SECONDS.observe(totals["seconds"], action=current.action, stage=stage)
+        if totals["size"]: STAGE_BYTES.inc(totals["size"], action=current.action, stage=stage)
+        if totals["pages"]: STAGE_PAGES.inc(totals["pages"], action=current.action, stage=stage)
+    if current.profile and "serialize" in current.stages:
+        # Размер результата — то, что реально ушло пользователю; время записи включает промежуточные файлы
+        written = [current.stages[stage]["seconds"] for stage in ("optimize", "serialize") if stage in current.stages]
+        WRITE_SECONDS.observe(sum(written), action=current.action, profile=current.profile)
+        if "upload" in current.stages:
+            OUTPUT_BYTES.observe(current.stages["upload"]["size"], action=current.action, profile=current.profile)
+    if JOB_LOG:
+        spans = {stage: {"seconds": round(t["seconds"], 4), "bytes": t["size"], "pages": t["pages"], "count": t["count"]}
+                 for stage, t in current.stages.items()}
+        logger.info(json.dumps({"event": "job", "action": current.action, "user": current.user, "status": status,
+                                "profile": current.profile or None, "seconds": round(duration, 4), "failed_stage": current.failed_stage, "spans": spans}))
+
+
+@contextmanager
+def span(stage: str, size: int = 0, pages: int = 0):
+    """Стадия текущей задачи. Размер и число страниц можно дописать в span внутри блока.
+    Вне задачи (фоновые загрузки и т. п.) ничего не записывает."""
+    info = Span(stage, size, pages)
+    started = time.perf_counter()
+    try: yield info
+    except BaseException:
+        current = _current_job.get()
+        if current is not None and current.failed_stage is None: current.failed_stage = stage
+        raise
+    finally:
+        current = _current_job.get()
+        if current is not None: current.add(stage, time.perf_counter() - started, info.size, info.pages)
+
+
+@contextmanager
+def collect():
+    """Собирает стадии без отчета — в процессах пула; вызывающий передает их в merge()."""
+    collector = Job(action="", user="")
+    token = _current_job.set(collector)
+    try: yield collector
+    finally: _current_job.reset(token)
+
+def merge(stages: dict[str, dict]) -> None:
+    """Добавляет стадии, собранные в процессе пула, к текущей задаче."""
+    current = _current_job.get()
+    if current is None: return
+    for stage, totals in stages.items(): current.add(stage, **totals)
+
+
+async def timed_iter(stage: str, source):
+    """Пробрасывает асинхронный итератор источников PDF и записывает в стадию время,
+    которое задача ждала каждый следующий элемент (например, скачивание файлов)."""
+    try:
+        while True:
+            started = time.perf_counter()
+            try: item = await anext(source)
+            except StopAsyncIteration: return
+            current = _current_job.get()
+            if current is not None: current.add(stage, time.perf_counter() - started, source_size(item))
+            yield item
+    finally:
+        if hasattr(source, "aclose"): await source.aclose()
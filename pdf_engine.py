@@ -0,0 +1,404 @@
+import os
+import time
+import asyncio
+import logging
+import tempfile
+import importlib.util
+from collections import OrderedDict, deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from itertools import islice
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Пул процессов для тяжелой работы с PDF ---
+# PDF_WORKERS=0 (или не задано) — по числу ядер
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", "0")) or None
+# Сколько страниц рендерить за одну задачу в пуле
+RENDER_BATCH = int(os.getenv("PDF_RENDER_BATCH", "4"))
+# Сколько готовых картинок может ждать отправки (ограничивает память конвейера)
+RENDER_QUEUE = int(os.getenv("PDF_RENDER_QUEUE", "16"))
+# Сколько файлов объединять в одной задаче, пока остальные еще скачиваются
+MERGE_CHUNK = int(os.getenv("PDF_MERGE_CHUNK", "4"))
+# Сколько сборок держать в работе одновременно (по умолчанию — по числу процессов пула)
+ASSEMBLY_PARALLEL = int(os.getenv("PDF_ASSEMBLY_PARALLEL", "0"))
+# Частей разбивки на одну задачу пула: меньше — раньше уходит первая часть, больше — меньше накладных расходов
+SPLIT_BATCH = int(os.getenv("PDF_SPLIT_BATCH", "8"))
+# Сколько разобранных документов держит каждый процесс пула (по одному на задачу, идущую одновременно)
+WORKER_DOCS = int(os.getenv("PDF_WORKER_DOCS", "8"))
+
+# PDF_PREWARM=1 — процессы пула запускаются и загружают PyMuPDF сразу при старте бота, а не на первой задаче
+PDF_PREWARM = os.getenv("PDF_PREWARM", "0") == "1"
+
+# WebP кодируется через Pillow, если он установлен; PyMuPDF сам умеет только PNG/JPEG
+WEBP_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+_executor: ProcessPoolExecutor | None = None
+# PyMuPDF нужен только процессам пула, поэтому основной процесс его не импортирует:
+# так бот быстрее стартует и занимает меньше памяти
+fitz = None
+
+
+def _load_fitz() -> None:
+    global fitz
+    if fitz is None:
+        import fitz  # PyMuPDF
+
+def _init_worker() -> None:
+    _load_fitz()
+    fitz.open().close()  # первое обращение к MuPDF тоже небесплатно
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=PDF_WORKERS, initializer=_init_worker)
+        logger.info(f"Запущен пул PDF-обработчиков на {_executor._max_workers} процесс(ов)")
+    return _executor
+
+def shutdown_executor(wait: bool = False) -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait, cancel_futures=True); _executor = None
+
+def _timed(func, *args):
+    # Выполняется в процессе пула: стадии (parse/transform/serialize) возвращаются вместе с результатом
+    with metrics.collect() as spans:
+        # Исключения MuPDF держат SWIG-объекты и не передаются из процесса пула — отдаем только текст
+        try: result = func(*args)
+        except Exception as e: raise RuntimeError(f"{type(e).__name__}: {e}") from None
+    return result, spans.stages
+
+async def prewarm() -> None:
+    """Запускает все процессы пула заранее и ждет, пока они загрузят PyMuPDF."""
+    started = time.perf_counter()
+    executor = get_executor(); loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(executor, _load_fitz) for _ in range(executor._max_workers)))
+    logger.info(f"Пул PDF-обработчиков прогрет за {time.perf_counter() - started:.2f} с")
+
+_prewarm_task: asyncio.Task | None = None
+
+def start_prewarm() -> None:
+    """Прогрев пула в фоне, чтобы не задерживать старт бота."""
+    global _prewarm_task
+    if _prewarm_task is None: _prewarm_task = asyncio.ensure_future(prewarm())
+
+async def run_in_pool(func, *args):
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+    try: result, stages = await loop.run_in_executor(executor, _timed, func, *args)
+    except BrokenProcessPool:
+        # Процесс пула умер (падение MuPDF, OOM killer) — пул больше не принимает задач.
+        # Ошибка достается только текущим задачам, следующая получит новый пул
+        if _executor is executor:
+            logger.error("Процесс пула PDF-обработчиков аварийно завершился, пул будет пересоздан"); shutdown_executor()
+        raise
+    metrics.merge(stages)
+    return result
+
+
+@asynccontextmanager
+async def _as_path(src: bytes | str, prefix: str):
+    """Дает путь к PDF на диске: путь возвращается как есть, байты сохраняются во временный файл."""
+    if isinstance(src, str):
+        yield src; return
+    fd, path = tempfile.mkstemp(prefix=prefix, suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as f: await asyncio.to_thread(f.write, src)
+        yield path
+    finally: os.remove(path)
+
+
+@dataclass(frozen=True)
+class RenderOptions:
+    dpi: int = 200
+    fmt: str = "png"  # png | jpg | webp
+    quality: int = 85  # для jpg/webp
+    grayscale: bool = False
+
+    @property
+    def extension(self) -> str:
+        return self.fmt
+
+
+@dataclass(frozen=True)
+class WriteOptions:
+    """Как сохранять результат: размер файла против времени записи."""
+    name: str = "default"
+    garbage: int = 3  # 1 — убрать неиспользуемые объекты, 3 — и склеить одинаковые, 4 — сравнивать и содержимое потоков
+    deflate: bool = True
+    use_objstms: bool = True  # мелкие объекты упаковываются в сжатые object streams
+    downsample_dpi: int = 0  # 0 — картинки не трогать, иначе пересжать то, что показано с большим разрешением
+    image_quality: int = 75
+
+
+# garbage=4 находит одинаковые потоки, то есть один и тот же шрифт или картинку из разных входных файлов
+WRITE_PROFILES = {
+    "fast": WriteOptions("fast", garbage=0, deflate=False, use_objstms=False),
+    "default": WriteOptions("default"),
+    "compact": WriteOptions("compact", garbage=4),
+    "email": WriteOptions("email", garbage=4, downsample_dpi=110, image_quality=60),
+}
+# Профиль по действию: PDF_WRITE_PROFILE_SPLIT=fast и т. п.
+_ACTION_PROFILES = {"split": "default", "combine": "compact", "assembly": "compact"}
+# Промежуточные файлы объединения все равно будут разобраны заново — их пишем быстро
+_INTERMEDIATE = WRITE_PROFILES["fast"]
+
+
+def write_options(action: str, profile: str | None = None) -> WriteOptions:
+    name = profile or os.getenv(f"PDF_WRITE_PROFILE_{action.upper()}", _ACTION_PROFILES.get(action, "default"))
+    if name not in WRITE_PROFILES:
+        logger.warning(f"Неизвестный профиль записи {name!r} для {action}, использую default"); name = "default"
+    return WRITE_PROFILES[name]
+
+
+# --- Расчет диапазонов для разбивки ---
+def split_ranges(mode: str, total_pages: int, custom_order: list[int] | None = None) -> Iterator[tuple[int, int]]:
+    """Диапазоны страниц частей (с нуля, включительно) — лениво, по одному."""
+    if mode == 'split_single': yield from ((i, i) for i in range(total_pages))
+    elif mode == 'split_double': yield from ((i, min(i + 1, total_pages - 1)) for i in range(0, total_pages, 2))
+    elif mode == 'split_custom':
+        current_page = 0
+        for part_size in custom_order or []:
+            if current_page >= total_pages: break
+            end_page = min(current_page + part_size, total_pages)
+            if end_page > current_page: yield current_page, end_page - 1
+            current_page = end_page
+
+
+# --- Функции, которые выполняются внутри процессов пула ---
+# Они должны быть на уровне модуля, чтобы их можно было передать в пул.
+
+# Кэш открытых документов внутри процесса пула: общий файл сборки разбирается
+# каждым процессом один раз, а не для каждого уникального файла. Общие файлы (pinned)
+# вытесняются последними, чтобы параллельные разбивки и рендер не выталкивали их между сборками.
+_worker_docs: OrderedDict = OrderedDict()  # ключ -> (документ, pinned)
+
+def _open_cached(path: str, pinned: bool = False) -> "fitz.Document":
+    stat = os.stat(path); key = (path, stat.st_mtime_ns, stat.st_size)
+    cached = _worker_docs.get(key)
+    if cached is None:
+        pdf_doc = fitz.open(path)
+        _worker_docs[key] = (pdf_doc, pinned)
+        while len(_worker_docs) > max(1, WORKER_DOCS):
+            others = [k for k in _worker_docs if k != key]  # только что открытый документ нужен задаче
+            victim = next((k for k in others if not _worker_docs[k][1]), others[0])
+            _worker_docs.pop(victim)[0].close()
+        return pdf_doc
+    _worker_docs.move_to_end(key)
+    if pinned and not cached[1]: _worker_docs[key] = (cached[0], True)
+    return cached[0]
+
+def _open_source(src: bytes | str) -> "fitz.Document":
+    # Путь (например, от локального Bot API сервера) открывается напрямую, без копии в памяти
+    with metrics.span("parse", size=metrics.source_size(src)) as span:
+        pdf_doc = fitz.open(src) if isinstance(src, str) else fitz.open(stream=src, filetype="pdf")
+        span.pages = pdf_doc.page_count
+    return pdf_doc
+
+def _downsample_images(pdf_doc: "fitz.Document", dpi: int, quality: int) -> None:
+    """Пересжимает в JPEG картинки, показанные на странице с разрешением больше dpi.
+    Картинки с прозрачностью и масками не трогаются; поток заменяется на месте, поэтому
+    все страницы, которые ссылаются на картинку, получают уменьшенную версию."""
+    done = set()
+    for page in pdf_doc:
+        for xref, smask, *_ in page.get_images(full=True):
+            if xref in done: continue
+            done.add(xref)
+            if smask or any(pdf_doc.xref_get_key(xref, key)[0] != "null" for key in ("Mask", "ImageMask")): continue
+            rects = page.get_image_rects(xref)
+            shown_inches = max((rect.width for rect in rects), default=0) / 72
+            pix = fitz.Pixmap(pdf_doc, xref)
+            if not shown_inches or pix.width / shown_inches <= dpi: continue
+            if pix.n - pix.alpha not in (1, 3): pix = fitz.Pixmap(fitz.csRGB, pix)
+            if pix.alpha: pix = fitz.Pixmap(pix, 0)
+            scale = dpi * shown_inches / pix.width
+            small = fitz.Pixmap(pix, max(1, round(pix.width * scale)), max(1, round(pix.height * scale)), None)
+            data = small.tobytes("jpg", jpg_quality=quality)
+            if len(data) >= len(pdf_doc.xref_stream_raw(xref) or b""): continue
+            pdf_doc.update_stream(xref, data, compress=False)
+            for key, value in (("Filter", "/DCTDecode"), ("Width", str(small.width)), ("Height", str(small.height)),
+                               ("ColorSpace", "/DeviceGray" if small.n == 1 else "/DeviceRGB"), ("BitsPerComponent", "8"),
+                               ("DecodeParms", "null"), ("Decode", "null")):
+                pdf_doc.xref_set_key(xref, key, value)
+
+def _optimize(pdf_doc: "fitz.Document", options: WriteOptions) -> None:
+    if options.downsample_dpi:
+        with metrics.span("optimize", pages=pdf_doc.page_count):
+            _downsample_images(pdf_doc, options.downsample_dpi, options.image_quality)
+
+def _write(pdf_doc: "fitz.Document", options: WriteOptions) -> bytes:
+    _optimize(pdf_doc, options)
+    with metrics.span("serialize", pages=pdf_doc.page_count) as span:
+        data = pdf_doc.write(garbage=options.garbage, deflate=options.deflate, use_objstms=int(options.use_objstms))
+        span.size = len(data)
+    return data
+
+def _save(pdf_doc: "fitz.Document", options: WriteOptions, path: str) -> None:
+    """Как _write, но MuPDF пишет сразу в файл, без копии результата в памяти."""
+    _optimize(pdf_doc, options)
+    with metrics.span("serialize", pages=pdf_doc.page_count) as span:
+        pdf_doc.save(path, garbage=options.garbage, deflate=options.deflate, use_objstms=int(options.use_objstms))
+        span.size = os.path.getsize(path)
+
+def _page_count(src: bytes | str) -> int:
+    if isinstance(src, str):
+        with metrics.span("parse", size=metrics.source_size(src)) as span:
+            span.pages = _open_cached(src).page_count
+        return span.pages
+    with _open_source(src) as pdf_doc:
+        return pdf_doc.page_count
+
+def _split_parts(src_path: str, ranges: list[tuple[int, int]], options: WriteOptions, part_dir: str,
+                 first_number: int) -> list[tuple[int, str]]:
+    # Исходный файл разбирается каждым процессом один раз на всю разбивку (кэш документов процесса)
+    with metrics.span("parse"): pdf_doc = _open_cached(src_path)
+    parts = []
+    for number, (first, last) in enumerate(ranges, first_number):
+        # Отмененная разбивка: каталог уже удален, а задачу пула прервать нельзя — дальше не работаем
+        if not os.path.isdir(part_dir): break
+        with fitz.open() as new_doc:
+            with metrics.span("transform", pages=last - first + 1):
+                new_doc.insert_pdf(pdf_doc, from_page=first, to_page=last)
+            path = os.path.join(part_dir, f"part_{number}.pdf")
+            _save(new_doc, options, path)
+        parts.append((number, path))
+    return parts
+
+def _merge(sources: list[bytes | str], options: WriteOptions) -> bytes:
+    with fitz.open() as result_doc:
+        for src in sources:
+            with _open_source(src) as pdf_doc, metrics.span("transform", pages=pdf_doc.page_count):
+                result_doc.insert_pdf(pdf_doc)
+        return _write(result_doc, options)
+
+def _assemble(unique: bytes | str, common_path: str, options: WriteOptions) -> bytes:
+    # insert_pdf копирует шрифты и картинки общего файла один раз на результат (через graft map)
+    with _open_source(unique) as result_doc:
+        with metrics.span("parse"): common_doc = _open_cached(common_path, pinned=True)
+        with metrics.span("transform", pages=common_doc.page_count): result_doc.insert_pdf(common_doc)
+        return _write(result_doc, options)
+
+def _encode_pixmap(pix: "fitz.Pixmap", options: RenderOptions) -> bytes:
+    if options.fmt == "jpg": return pix.tobytes("jpg", jpg_quality=options.quality)
+    if options.fmt == "webp":
+        import io
+        from PIL import Image
+        mode = "L" if pix.n == 1 else "RGB"
+        buffer = io.BytesIO()
+        Image.frombytes(mode, (pix.width, pix.height), pix.samples).save(buffer, "WEBP", quality=options.quality)
+        return buffer.getvalue()
+    return pix.tobytes("png")
+
+def _render_pages(src_path: str, page_indices: list[int], options: RenderOptions) -> list[bytes]:
+    with metrics.span("parse"): pdf_doc = _open_cached(src_path)
+    colorspace = fitz.csGRAY if options.grayscale else fitz.csRGB
+    images = []
+    for page_index in page_indices:
+        with metrics.span("transform", pages=1):
+            pix = pdf_doc.load_page(page_index).get_pixmap(dpi=options.dpi, colorspace=colorspace, alpha=False)
+        with metrics.span("serialize") as span:
+            images.append(_encode_pixmap(pix, options)); span.size = len(images[-1])
+    return images
+
+
+# --- Асинхронный интерфейс для обработчиков бота ---
+async def page_count(src: bytes | str) -> int:
+    return await run_in_pool(_page_count, src)
+
+async def split_stream(src_path: str, ranges: Iterable[tuple[int, int]], part_dir: str,
+                       options: WriteOptions = WRITE_PROFILES["default"]):
+    """Асинхронный генератор частей разбивки (номер с 1, путь <part_dir>/part_<N>.pdf) в исходном порядке.
+    Диапазоны читаются лениво пачками по SPLIT_BATCH; пачки собираются в пуле параллельно, пока потребитель
+    отправляет готовые части, но в работе не больше пачки на процесс. Части пишутся сразу на диск;
+    каталог part_dir принадлежит вызывающему: он удаляет отправленные части и сам каталог."""
+    parallel = get_executor()._max_workers
+    pending, ranges, number = deque(), iter(ranges), 1
+    try:
+        while batch := list(islice(ranges, SPLIT_BATCH)):
+            pending.append(asyncio.ensure_future(run_in_pool(_split_parts, src_path, batch, options, part_dir, number)))
+            number += len(batch)
+            # Пока потребитель отправляет части готовой пачки, в пуле собираются следующие parallel пачек
+            if len(pending) > parallel:
+                for part in await pending.popleft(): yield part
+        while pending:
+            for part in await pending.popleft(): yield part
+    finally:
+        for task in pending: task.cancel()
+
+async def merge(sources: list[bytes | str], options: WriteOptions = WRITE_PROFILES["default"]) -> bytes:
+    return await run_in_pool(_merge, sources, options)
+
+async def merge_stream(sources, options: WriteOptions = WRITE_PROFILES["default"]) -> bytes:
+    """Объединяет PDF из асинхронного итератора: пачки по MERGE_CHUNK уходят в пул,
+    как только готовы, а в конце части склеиваются в один файл. Оптимизация записи
+    (options) делается один раз — на итоговом файле."""
+    tasks, chunk = [], []
+    try:
+        async for src in sources:
+            chunk.append(src)
+            if len(chunk) == MERGE_CHUNK:
+                tasks.append(asyncio.ensure_future(merge(chunk, _INTERMEDIATE))); chunk = []
+        if not tasks: return await merge(chunk, options)
+        if chunk: tasks.append(asyncio.ensure_future(merge(chunk, _INTERMEDIATE)))
+        parts = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks: task.cancel()
+        raise
+    return await merge(parts, options)
+
+async def assemble_many(common: bytes | str, uniques, options: WriteOptions = WRITE_PROFILES["default"]):
+    """Асинхронный генератор сборок "уникальный + общий" в исходном порядке.
+    Общий файл один раз сохраняется во временный файл, сборки идут параллельно в пуле."""
+    parallel = ASSEMBLY_PARALLEL or get_executor()._max_workers
+    pending = deque()
+    async with _as_path(common, "pdf_bot_common_") as common_path:
+        try:
+            async for unique in uniques:
+                pending.append(asyncio.ensure_future(run_in_pool(_assemble, unique, common_path, options)))
+                if len(pending) >= parallel: yield await pending.popleft()
+            while pending: yield await pending.popleft()
+        finally:
+            for task in pending: task.cancel()
+
+async def render_pages(src: bytes | str, page_indices: list[int], options: RenderOptions = RenderOptions()):
+    """Конвейер рендера: асинхронный генератор (номер страницы, байты картинки).
+    Пачки страниц рендерятся в пуле с опережением, пока потребитель отправляет готовые;
+    очередь на RENDER_QUEUE картинок не дает рендеру уйти слишком далеко вперед."""
+    queue: asyncio.Queue = asyncio.Queue(maxsize=RENDER_QUEUE)
+    done = object()
+
+    async def produce(src_path: str):
+        pending = deque()
+        try:
+            for i in range(0, len(page_indices), RENDER_BATCH):
+                batch = page_indices[i:i + RENDER_BATCH]
+                pending.append((batch, asyncio.ensure_future(run_in_pool(_render_pages, src_path, batch, options))))
+                if len(pending) >= get_executor()._max_workers: await _drain(pending.popleft())
+            while pending: await _drain(pending.popleft())
+        finally:
+            for _, future in pending: future.cancel()
+
+    async def _drain(item):
+        batch, future = item
+        for page_index, img_bytes in zip(batch, await future): await queue.put((page_index, img_bytes))
+
+    async with _as_path(src, "pdf_bot_render_") as src_path:
+        async def run_producer():
+            cancelled = False
+            try: await produce(src_path)
+            except asyncio.CancelledError:
+                cancelled = True; raise
+            finally:
+                # Отмененному производителю признак конца не нужен: потребитель уже ушел,
+                # а put в полную очередь повис бы навсегда вместе с готовыми картинками
+                if not cancelled: await queue.put(done)
+        producer = asyncio.create_task(run_producer())
+        try:
+            while (item := await queue.get()) is not done: yield item
+            await producer  # пробрасываем ошибку рендера, если она была
+        finally: producer.cancel()
@@ -0,0 +1,148 @@
+import os
+import re
+import time
+import uuid
+import pickle
+import asyncio
+import logging
+import tempfile
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from state_backend import StateBackend, backend
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки хранилища незавершенных сессий ---
+SESSION_DIR = os.getenv("SESSION_DIR", os.path.join(tempfile.gettempdir(), "pdf_bot_sessions"))
+SESSION_TTL = int(os.getenv("SESSION_TTL", "1800"))  # секунды без активности до удаления
+SESSION_USER_MAX_BYTES = int(os.getenv("SESSION_USER_MAX_MB", "200")) * 1024 * 1024
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_MB", "2048")) * 1024 * 1024
+MEDIA_GROUP_TTL = int(os.getenv("MEDIA_GROUP_TTL", "120"))
+_BLOB_NAME = re.compile(r"-?\d+_[0-9a-f]{32}\.pdf")
+
+
+class SessionStoreFull(Exception):
+    pass
+
+
+@dataclass
+class _Blob:
+    user_id: int
+    size: int
+    touched_at: float = field(default_factory=time.time)
+
+
+class BlobStore:
+    """PDF незавершенных диалогов лежат во временных файлах, а в user_data хранится только путь.
+    Есть бюджет на пользователя и общий, брошенные сессии удаляются по TTL."""
+
+    def __init__(self, base_dir: str = SESSION_DIR, ttl: float = SESSION_TTL,
+                 user_max_bytes: int = SESSION_USER_MAX_BYTES, max_bytes: int = SESSION_MAX_BYTES):
+        self.base_dir, self.ttl, self.user_max_bytes, self.max_bytes = base_dir, ttl, user_max_bytes, max_bytes
+        self._blobs: OrderedDict[str, _Blob] = OrderedDict()  # путь -> метаданные, порядок LRU
+        self.bytes_held = 0
+        self.expired = 0
+        # Файлы сессий, к которым давно не обращались, после перезапуска никому не принадлежат.
+        # Свежие не трогаем: каталог могут делить другие процессы бота на этом хосте
+        os.makedirs(self.base_dir, exist_ok=True)
+        deadline = time.time() - self.ttl
+        for name in os.listdir(self.base_dir):
+            if not _BLOB_NAME.fullmatch(name): continue
+            path = os.path.join(self.base_dir, name)
+            try:
+                if os.path.getmtime(path) < deadline: os.remove(path)
+            except FileNotFoundError: pass
+
+    def _user_bytes(self, user_id: int) -> int:
+        return sum(blob.size for blob in self._blobs.values() if blob.user_id == user_id)
+
+    def _make_room(self, user_id: int, size: int) -> None:
+        if size > self.user_max_bytes or size > self.max_bytes:
+            raise SessionStoreFull(f"Файл {size} байт больше допустимого бюджета сессии")
+        for path in [p for p, b in self._blobs.items() if b.user_id == user_id]:
+            if self._user_bytes(user_id) + size <= self.user_max_bytes: break
+            self.release(path)
+        # Общий бюджет: вытесняем самые давно неиспользуемые сессии
+        while self.bytes_held + size > self.max_bytes and self._blobs:
+            path, blob = next(iter(self._blobs.items()))
+            logger.warning(f"Бюджет сессий исчерпан, удаляю файл пользователя {blob.user_id}")
+            self.release(path)
+
+    async def put(self, user_id: int, data: bytes) -> str:
+        self._make_room(user_id, len(data))
+        path = os.path.join(self.base_dir, f"{user_id}_{uuid.uuid4().hex}.pdf")
+        await asyncio.to_thread(_write_file, path, data)
+        self._blobs[path] = _Blob(user_id, len(data)); self.bytes_held += len(data)
+        return path
+
+    def get(self, path: str | None) -> str | None:
+        """Возвращает путь, если файл еще жив, и продлевает ему жизнь (и время изменения на диске,
+        по которому чистят каталог другие процессы)."""
+        blob = self._blobs.get(path) if path else None
+        if blob is None: return None
+        try: os.utime(path)
+        except FileNotFoundError:
+            self.release(path); return None
+        blob.touched_at = time.time(); self._blobs.move_to_end(path)
+        return path
+
+    def release(self, path: str) -> None:
+        blob = self._blobs.pop(path, None)
+        if blob is None: return
+        self.bytes_held -= blob.size
+        try: os.remove(path)
+        except FileNotFoundError: pass
+
+    def release_user(self, user_id: int) -> None:
+        for path in [p for p, b in self._blobs.items() if b.user_id == user_id]: self.release(path)
+
+    def sweep(self) -> None:
+        deadline = time.time() - self.ttl
+        for path in [p for p, b in self._blobs.items() if b.touched_at < deadline]:
+            self.release(path); self.expired += 1
+
+    def stats(self) -> dict:
+        return {"session_blobs": len(self._blobs), "session_bytes": self.bytes_held,
+                "session_users": len({b.user_id for b in self._blobs.values()}), "session_expired": self.expired}
+
+
+class MediaGroupBuffer:
+    """Документы альбомов, которые еще ждут таймера. Лежат в StateBackend вместе с дедлайном
+    таймера, поэтому альбом может собрать любой экземпляр бота; забытые группы удаляются по TTL."""
+
+    def __init__(self, backend: StateBackend, ttl: float = MEDIA_GROUP_TTL):
+        self.backend, self.ttl = backend, ttl
+
+    async def append(self, media_group_id: str, document, meta: dict, deadline: float) -> None:
+        await self.backend.run("push", "media_group_docs", media_group_id, pickle.dumps(document))
+        await self.backend.run("set", "media_group_meta", media_group_id, pickle.dumps({**meta, 'deadline': deadline}), self.ttl)
+
+    async def deadline(self, media_group_id: str) -> float | None:
+        row = await self.backend.run("get", "media_group_meta", media_group_id)
+        return pickle.loads(row[1])['deadline'] if row else None
+
+    async def due(self) -> list[str]:
+        now = time.time()
+        return [group_id for group_id, (_, value) in (await self.backend.run("items", "media_group_meta")).items() if pickle.loads(value)['deadline'] <= now]
+
+    async def pop(self, media_group_id: str) -> tuple[list, dict] | None:
+        """Забирает альбом целиком; если его уже забрал другой таймер или узел, вернет None."""
+        meta = await self.backend.run("take", "media_group_meta", media_group_id)
+        if meta is None: return None
+        documents = [pickle.loads(value) for value in await self.backend.run("take_list", "media_group_docs", media_group_id)]
+        return documents, pickle.loads(meta)
+
+    async def sweep(self) -> None:
+        older_than = time.time() - self.ttl
+        await self.backend.run("purge", "media_group_meta", older_than); await self.backend.run("purge", "media_group_docs", older_than)
+
+    async def stats(self) -> dict:
+        return {"media_groups": len(await self.backend.run("items", "media_group_meta"))}
+
+
+def _write_file(path: str, data: bytes) -> None:
+    with open(path, "wb") as f: f.write(data)
+
+
+blob_store = BlobStore()
+media_group_files = MediaGroupBuffer(backend)
@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import pickle
+import asyncio
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from telegram import Update
+from telegram.ext import BasePersistence, ConversationHandler, PersistenceInput, TypeHandler
+
+logger = logging.getLogger(__name__)
+
+# --- Общее хранилище состояния ---
+# STATE_DB — путь к файлу SQLite. Если не задан, состояние живет только в памяти процесса.
+STATE_DB = os.getenv("STATE_DB")
+# Как часто (сек) PTB сбрасывает user_data и состояния диалогов в хранилище
+STATE_UPDATE_INTERVAL = float(os.getenv("STATE_UPDATE_INTERVAL", "1"))
+
+
+class StateBackend(ABC):
+    """Минимальный интерфейс хранилища: пространства имен с ключами и версиями + атомарные списки.
+    Его может реализовать любое Redis-подобное хранилище (HSET/INCR, RPUSH/LRANGE+DEL в MULTI).
+    Методы синхронные; из цикла событий их вызывают через run()."""
+
+    blocking = False  # True — методы ждут диск или сеть, и run() выполняет их в потоке
+
+    async def run(self, method: str, *args):
+        """Вызывает метод хранилища из asyncio, не останавливая цикл событий на блокирующих запросах."""
+        func = getattr(self, method)
+        return await asyncio.to_thread(func, *args) if self.blocking else func(*args)
+
+    @abstractmethod
+    def get(self, namespace: str, key: str) -> tuple[int, bytes] | None:
+        """Возвращает (версия, значение) или None."""
+
+    @abstractmethod
+    def set(self, namespace: str, key: str, value: bytes, ttl: float | None = None) -> int:
+        """Сохраняет значение и возвращает его новую версию."""
+
+    @abstractmethod
+    def delete(self, namespace: str, key: str) -> None: ...
+
+    @abstractmethod
+    def items(self, namespace: str) -> dict[str, tuple[int, bytes]]: ...
+
+    @abstractmethod
+    def take(self, namespace: str, key: str) -> bytes | None:
+        """Атомарно читает и удаляет значение: забрать его сможет только один узел."""
+
+    @abstractmethod
+    def push(self, namespace: str, key: str, value: bytes) -> None: ...
+
+    @abstractmethod
+    def take_list(self, namespace: str, key: str) -> list[bytes]:
+        """Атомарно забирает весь список в порядке добавления."""
+
+    @abstractmethod
+    def purge(self, namespace: str, older_than: float) -> None:
+        """Удаляет списки, созданные раньше older_than (unix time), и просроченные ключи."""
+
+
+class MemoryBackend(StateBackend):
+    """Хранилище в памяти процесса — поведение по умолчанию для одного экземпляра бота."""
+
+    def __init__(self):
+        self._kv: dict[tuple[str, str], tuple[int, bytes, float | None]] = {}
+        self._lists: dict[tuple[str, str], list[tuple[float, bytes]]] = defaultdict(list)
+
+    def get(self, namespace, key):
+        row = self._kv.get((namespace, key))
+        if row is None or (row[2] is not None and row[2] < time.time()): return None
+        return row[0], row[1]
+
+    def set(self, namespace, key, value, ttl=None):
+        old = self._kv.get((namespace, key)); version = old[0] + 1 if old else 1
+        self._kv[(namespace, key)] = (version, value, time.time() + ttl if ttl else None)
+        return version
+
+    def delete(self, namespace, key):
+        self._kv.pop((namespace, key), None)
+
+    def items(self, namespace):
+        now = time.time()
+        return {k: (v, value) for (ns, k), (v, value, exp) in self._kv.items() if ns == namespace and (exp is None or exp >= now)}
+
+    def take(self, namespace, key):
+        row = self._kv.pop((namespace, key), None)
+        return row[1] if row else None
+
+    def push(self, namespace, key, value):
+        self._lists[(namespace, key)].append((time.time(), value))
+
+    def take_list(self, namespace, key):
+        return [value for _, value in self._lists.pop((namespace, key), [])]
+
+    def purge(self, namespace, older_than):
+        for list_key in [k for k, rows in self._lists.items() if k[0] == namespace and rows and rows[0][0] < older_than]:
+            del self._lists[list_key]
+        now = time.time()
+        for kv_key in [k for k, row in self._kv.items() if k[0] == namespace and row[2] is not None and row[2] < now]:
+            del self._kv[kv_key]
+
+
+class SqliteBackend(StateBackend):
+    """SQLite-хранилище: переживает перезапуски, и один файл могут использовать несколько процессов
+    на одном хосте (одном томе). Сетевые ФС (NFS, SMB) не подходят: WAL держит индекс в общей памяти
+    процессов одной машины. Запрос может ждать чужую блокировку до timeout, поэтому blocking = True."""
+
+    blocking = True
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS kv (ns TEXT, key TEXT, value BLOB, version INTEGER, expires_at REAL, PRIMARY KEY (ns, key))")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS lists (id INTEGER PRIMARY KEY AUTOINCREMENT, ns TEXT, key TEXT, value BLOB, created_at REAL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS lists_key ON lists (ns, key)")
+
+    def _execute(self, sql: str, params: tuple = ()) -> list:
+        with self._lock: return self._conn.execute(sql, params).fetchall()
+
+    def _transaction(self, statements: list[tuple[str, tuple]]) -> list[list]:
+        # BEGIN IMMEDIATE сразу берет блокировку на запись, поэтому чтение+удаление атомарны и между процессами
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                results = [self._conn.execute(sql, params).fetchall() for sql, params in statements]
+                self._conn.execute("COMMIT")
+                return results
+            except BaseException:
+                self._conn.execute("ROLLBACK"); raise
+
+    def get(self, namespace, key):
+        rows = self._execute("SELECT version, value FROM kv WHERE ns = ? AND key = ? AND (expires_at IS NULL OR expires_at >= ?)", (namespace, key, time.time()))
+        return (rows[0][0], rows[0][1]) if rows else None
+
+    def set(self, namespace, key, value, ttl=None):
+        rows = self._execute(
+            "INSERT INTO kv (ns, key, value, version, expires_at) VALUES (?, ?, ?, 1, ?) "
+            "ON CONFLICT (ns, key) DO UPDATE SET value = excluded.value, version = kv.version + 1, expires_at = excluded.expires_at "
+            "RETURNING version", (namespace, key, value, time.time() + ttl if ttl else None))
+        return rows[0][0]
+
+    def delete(self, namespace, key):
+        self._execute("DELETE FROM kv WHERE ns = ? AND key = ?", (namespace, key))
+
+    def items(self, namespace):
+        rows = self._execute("SELECT key, version, value FROM kv WHERE ns = ? AND (expires_at IS NULL OR expires_at >= ?)", (namespace, time.time()))
+        return {key: (version, value) for key, version, value in rows}
+
+    def take(self, namespace, key):
+        rows, _ = self._transaction([
+            ("SELECT value FROM kv WHERE ns = ? AND key = ?", (namespace, key)),
+            ("DELETE FROM kv WHERE ns = ? AND key = ?", (namespace, key))])
+        return rows[0][0] if rows else None
+
+    def push(self, namespace, key, value):
+        self._execute("INSERT INTO lists (ns, key, value, created_at) VALUES (?, ?, ?, ?)", (namespace, key, value, time.time()))
+
+    def take_list(self, namespace, key):
+        rows, _ = self._transaction([
+            ("SELECT value FROM lists WHERE ns = ? AND key = ? ORDER BY id", (namespace, key)),
+            ("DELETE FROM lists WHERE ns = ? AND key = ?", (namespace, key))])
+        return [row[0] for row in rows]
+
+    def purge(self, namespace, older_than):
+        self._execute("DELETE FROM lists WHERE ns = ? AND created_at < ?", (namespace, older_than))
+        self._execute("DELETE FROM kv WHERE ns = ? AND expires_at IS NOT NULL AND expires_at < ?", (namespace, time.time()))
+
+
+def create_backend() -> StateBackend:
+    if STATE_DB:
+        logger.info(f"Состояние бота хранится в SQLite: {STATE_DB}")
+        return SqliteBackend(STATE_DB)
+    return MemoryBackend()
+
+
+backend = create_backend()
+
+
+# --- Persistence для PTB поверх StateBackend ---
+# Telegram-объекты (например, Document в списке файлов) сериализуются без бота,
+# то есть хранятся только ссылки на файлы (file_id), а не их содержимое.
+_dumps, _loads = pickle.dumps, pickle.loads
+
+
+class BackendPersistence(BasePersistence):
+    """Хранит user_data, chat_data, bot_data и состояния диалогов в StateBackend.
+    Перед каждым обновлением данные перечитываются, если их изменил другой экземпляр бота."""
+
+    def __init__(self, backend: StateBackend, update_interval: float = STATE_UPDATE_INTERVAL):
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self.backend = backend
+        self._versions: dict[tuple[str, str], int] = {}  # последняя версия, которую видел этот процесс
+
+    async def _load_all(self, namespace: str) -> dict:
+        result = {}
+        for key, (version, value) in (await self.backend.run("items", namespace)).items():
+            self._versions[(namespace, key)] = version; result[key] = _loads(value)
+        return result
+
+    async def _store(self, namespace: str, key: str, data: object) -> None:
+        self._versions[(namespace, key)] = await self.backend.run("set", namespace, key, _dumps(data))
+
+    async def _load_if_newer(self, namespace: str, key: str):
+        """Возвращает (True, данные), если в хранилище версия новее той, что видел этот процесс."""
+        row = await self.backend.run("get", namespace, key)
+        if row is None or row[0] <= self._versions.get((namespace, key), 0): return False, None
+        self._versions[(namespace, key)] = row[0]
+        return True, _loads(row[1])
+
+    async def get_user_data(self) -> dict:
+        return {int(k): v for k, v in (await self._load_all("user_data")).items()}
+
+    async def get_chat_data(self) -> dict:
+        return {int(k): v for k, v in (await self._load_all("chat_data")).items()}
+
+    async def get_bot_data(self) -> dict:
+        return (await self._load_all("bot_data")).get("bot", {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {tuple(json.loads(k)): v for k, v in (await self._load_all(f"conversation:{name}")).items()}
+
+    async def load_conversation_state(self, name: str, key: tuple):
+        return await self._load_if_newer(f"conversation:{name}", json.dumps(list(key)))
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        namespace, str_key = f"conversation:{name}", json.dumps(list(key))
+        if new_state is None:
+            await self.backend.run("delete", namespace, str_key); self._versions.pop((namespace, str_key), None)
+        else: await self._store(namespace, str_key, new_state)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        await self._store("user_data", str(user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        await self._store("chat_data", str(chat_id), data)
+
+    async def update_bot_data(self, data: dict) -> None:
+        await self._store("bot_data", "bot", data)
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self.backend.run("delete", "user_data", str(user_id))
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await self.backend.run("delete", "chat_data", str(chat_id))
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        changed, stored = await self._load_if_newer("user_data", str(user_id))
+        if changed: user_data.clear(); user_data.update(stored)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        changed, stored = await self._load_if_newer("chat_data", str(chat_id))
+        if changed: chat_data.clear(); chat_data.update(stored)
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        changed, stored = await self._load_if_newer("bot_data", "bot")
+        if changed: bot_data.clear(); bot_data.update(stored)
+
+    async def flush(self) -> None:
+        pass
+
+
+class SharedConversationHandler(ConversationHandler):
+    """ConversationHandler, который перед каждым обновлением сверяет состояние диалога с хранилищем:
+    следующий шаг диалога может прийти на другой экземпляр бота. check_update синхронный, поэтому
+    сверку делает обработчик из state_refresh_handler() в группе раньше диалога.
+    Опирается на внутренние _get_key/_conversations PTB (версия закреплена в requirements.txt)."""
+
+    async def _initialize_persistence(self, application):
+        self._shared_persistence = application.persistence
+        return await super()._initialize_persistence(application)
+
+    async def refresh_state(self, update: object, context=None) -> None:
+        persistence = getattr(self, "_shared_persistence", None)
+        if not isinstance(persistence, BackendPersistence) or not isinstance(update, Update): return
+        try: key = self._get_key(update)
+        except RuntimeError: return
+        changed, state = await persistence.load_conversation_state(self.name, key)
+        if changed: self._conversations.update_no_track({key: state})
+
+    def state_refresh_handler(self) -> TypeHandler:
+        """Добавляется в группу с меньшим номером: PTB дожидается ее обработчиков до check_update диалога."""
+        return TypeHandler(Update, self.refresh_state)
@@ -0,0 +1,24 @@
+from bot import parse_page_ranges
+
+
+def test_all_pages():
+    assert parse_page_ranges("все", 3) == [0, 1, 2]
+
+
+def test_ranges_and_single_pages():
+    assert parse_page_ranges("1-3, 5", 10) == [0, 1, 2, 4]
+
+
+def test_ranges_are_clamped_to_page_count():
+    assert parse_page_ranges("8-1000000000", 10) == [7, 8, 9]
+    assert parse_page_ranges("0, 11", 10) == []
+
+
+def test_overlapping_ranges_are_merged_in_order():
+    assert parse_page_ranges("5-7, 2-3, 3, 6-9", 10) == [1, 2, 4, 5, 6, 7, 8]
+
+
+def test_reversed_or_invalid_input():
+    assert parse_page_ranges("5-3", 10) == []
+    assert parse_page_ranges("-3", 10) == []
+    assert parse_page_ranges("abc", 10) == []
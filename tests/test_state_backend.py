@@ -0,0 +1,60 @@
+import asyncio
+import threading
+from state_backend import BackendPersistence, SqliteBackend
+
+
+def race(*funcs) -> list:
+    """Запускает функции одновременно в потоках и возвращает их результаты."""
+    start, results = threading.Barrier(len(funcs)), [None] * len(funcs)
+
+    def run(i, func):
+        start.wait(); results[i] = func()
+
+    threads = [threading.Thread(target=run, args=(i, func)) for i, func in enumerate(funcs)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    return results
+
+
+def test_only_one_connection_wins_take(tmp_path):
+    path = str(tmp_path / "state.db")
+    first, second = SqliteBackend(path), SqliteBackend(path)
+    keys = [f"group{i}" for i in range(50)]
+    for key in keys: first.set("meta", key, key.encode())
+    taken = race(lambda: [k for k in keys if first.take("meta", k) is not None],
+                 lambda: [k for k in keys if second.take("meta", k) is not None])
+    assert sorted(taken[0] + taken[1]) == sorted(keys)
+    assert not set(taken[0]) & set(taken[1])
+
+
+def test_take_list_is_atomic_across_connections(tmp_path):
+    path = str(tmp_path / "state.db")
+    first, second = SqliteBackend(path), SqliteBackend(path)
+    for i in range(20): first.push("docs", "album", str(i).encode())
+    taken = race(lambda: first.take_list("docs", "album"), lambda: second.take_list("docs", "album"))
+    assert sorted(taken, key=len) == [[], [str(i).encode() for i in range(20)]]
+
+
+def test_persistence_sees_only_newer_versions(tmp_path):
+    path = str(tmp_path / "state.db")
+    node_a, node_b = BackendPersistence(SqliteBackend(path)), BackendPersistence(SqliteBackend(path))
+
+    async def main():
+        await node_a.update_user_data(1, {"step": 1})
+        user_data = {}
+        await node_b.refresh_user_data(1, user_data)
+        assert user_data == {"step": 1}
+        # Повторное чтение той же версии не затирает то, что узел уже поменял у себя
+        user_data["local"] = True
+        await node_b.refresh_user_data(1, user_data)
+        assert user_data == {"step": 1, "local": True}
+        await node_b.update_user_data(1, {"step": 2})
+        # Узел не перечитывает собственную запись, а другой узел видит новую версию
+        own = {"step": 2}
+        await node_b.refresh_user_data(1, own)
+        assert own == {"step": 2}
+        seen_by_a = {"step": 1}
+        await node_a.refresh_user_data(1, seen_by_a)
+        assert seen_by_a == {"step": 2}
+
+    asyncio.run(main())
@@ -0,0 +1,62 @@
+import asyncio
+from datetime import datetime
+from telegram import Chat, Message, Update
+import update_processor
+from update_processor import ChatSerialUpdateProcessor
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+def make_update(update_id: int, chat_id: int, bot: FakeBot) -> Update:
+    message = Message(update_id, datetime.now(), Chat(chat_id, Chat.PRIVATE), text="x")
+    update = Update(update_id, message=message)
+    update.set_bot(bot)
+    return update
+
+
+def test_same_chat_updates_run_in_order():
+    events = []
+
+    async def handle(name: str, delay: float):
+        events.append(f"{name} start"); await asyncio.sleep(delay); events.append(f"{name} end")
+
+    async def main():
+        processor, bot = ChatSerialUpdateProcessor(max_concurrent_jobs=4), FakeBot()
+        await processor.initialize()
+        await asyncio.gather(
+            processor.do_process_update(make_update(1, 10, bot), handle("first", 0.05)),
+            processor.do_process_update(make_update(2, 10, bot), handle("second", 0)))
+        return processor
+
+    processor = asyncio.run(main())
+    assert events == ["first start", "first end", "second start", "second end"]
+    assert not processor._chat_locks and not processor._chat_refs
+
+
+def test_different_chats_run_in_parallel_under_cap(monkeypatch):
+    monkeypatch.setattr(update_processor, "QUEUE_NOTICE_INTERVAL", 0)
+    running = peak = 0
+
+    async def handle():
+        nonlocal running, peak
+        running += 1; peak = max(peak, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+
+    async def main():
+        processor, bot = ChatSerialUpdateProcessor(max_concurrent_jobs=2), FakeBot()
+        await processor.initialize()
+        await asyncio.gather(*(processor.do_process_update(make_update(i, 100 + i, bot), handle()) for i in range(3)))
+        return processor, bot
+
+    processor, bot = asyncio.run(main())
+    assert peak == 2
+    # Третий чат ждал свободного слота и узнал свое место в очереди
+    assert len(bot.sent) == 1 and bot.sent[0][0] == 102 and "очереди: 1" in bot.sent[0][1]
+    assert processor.queue_length == 0
@@ -0,0 +1,79 @@
+import os
+import time
+import asyncio
+import logging
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Параллельная обработка обновлений ---
+# Сколько обновлений (разных чатов) может обрабатываться одновременно
+MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", "8"))
+# Сколько обновлений может быть принято в работу вообще, включая ждущие своей очереди
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", "1024"))
+QUEUE_NOTICE_INTERVAL = 30  # не чаще одного сообщения об очереди в чат за это время
+
+
+class ChatSerialUpdateProcessor(BaseUpdateProcessor):
+    """Обновления разных чатов идут параллельно, а одного чата — строго по порядку,
+    чтобы не ломались ConversationHandler и сбор альбомов. Если все слоты заняты,
+    пользователь получает сообщение о своем месте в очереди."""
+
+    def __init__(self, max_concurrent_jobs: int = MAX_CONCURRENT_JOBS, max_pending_updates: int = MAX_PENDING_UPDATES):
+        super().__init__(max_concurrent_updates=max_pending_updates)
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self._jobs: asyncio.Semaphore | None = None
+        self._chat_locks: dict[int, asyncio.Lock] = {}
+        self._chat_refs: dict[int, int] = {}
+        self._waiting = 0
+        self._notified: dict[int, float] = {}
+
+    async def initialize(self) -> None:
+        self._jobs = asyncio.Semaphore(self.max_concurrent_jobs)
+
+    async def shutdown(self) -> None:
+        self._chat_locks.clear(); self._chat_refs.clear(); self._notified.clear()
+
+    @property
+    def queue_length(self) -> int:
+        return self._waiting
+
+    async def _notify_queue(self, update: Update, chat_id: int, position: int) -> None:
+        now = time.monotonic()
+        if now - self._notified.get(chat_id, 0) < QUEUE_NOTICE_INTERVAL: return
+        self._notified[chat_id] = now
+        try: await update.get_bot().send_message(chat_id, f"Сейчас много задач. Ваше место в очереди: {position}. Я начну, как только освободится место.")
+        except Exception as e: logger.warning(f"Не удалось сообщить об очереди в чат {chat_id}: {e}")
+
+    async def _run_job(self, update: object, coroutine, chat_id: int | None, received: float) -> None:
+        try:
+            if self._jobs.locked():
+                self._waiting += 1
+                if chat_id is not None: await self._notify_queue(update, chat_id, self._waiting)
+                try: await self._jobs.acquire()
+                finally: self._waiting -= 1
+            else: await self._jobs.acquire()
+        except BaseException:
+            coroutine.close(); raise  # остановка приложения, пока обновление ждало очереди
+        # Обработчик выполняется в этой же задаче и увидит время ожидания через contextvar
+        metrics.set_queue_wait(time.monotonic() - received)
+        try: await coroutine
+        finally: self._jobs.release()
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        received = time.monotonic()
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await self._run_job(update, coroutine, None, received); return
+        chat_id = chat.id
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        self._chat_refs[chat_id] = self._chat_refs.get(chat_id, 0) + 1
+        try:
+            # asyncio.Lock отдает блокировку в порядке ожидания, то есть в порядке прихода обновлений
+            async with lock: await self._run_job(update, coroutine, chat_id, received)
+        finally:
+            self._chat_refs[chat_id] -= 1
+            if not self._chat_refs[chat_id]:
+                del self._chat_refs[chat_id]; del self._chat_locks[chat_id]; self._notified.pop(chat_id, None)
@@ -0,0 +1,151 @@
+"""Вебхук-сервер бота. Импортирует только легкие модули, поэтому порт открывается в первые
+миллисекунды после старта процесса: Telegram сразу получает 200, а обновления ждут в буфере,
+пока в фоне загружаются telegram.ext, обработчики и пул PDF-процессов."""
+import os
+import json
+import time
+import signal
+import asyncio
+import importlib
+import logging
+from http import HTTPStatus
+from tornado.httpserver import HTTPServer
+from tornado.httputil import HTTPHeaders, HTTPServerRequest, ResponseStartLine
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Если задан, /metrics отдается только с заголовком "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+WEBHOOK_BUFFER_MAX = int(os.getenv("WEBHOOK_BUFFER_MAX", "1000"))  # обновлений в буфере, пока бот загружается
+
+
+def _process_age() -> float:
+    """Сколько секунд назад запущен процесс (включая старт интерпретатора), если это можно узнать."""
+    try:
+        with open("/proc/self/stat") as f: start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f: uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError): return 0.0
+
+
+class StartupTimer:
+    """Разбивка времени старта по фазам для лога."""
+
+    def __init__(self):
+        self.started = time.perf_counter() - _process_age()
+        self._last = self.started
+        self.phases: list[tuple[str, float]] = []
+
+    def mark(self, phase: str) -> None:
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last)); self._last = now
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def report(self) -> None:
+        breakdown = ", ".join(f"{phase} {seconds:.2f}" for phase, seconds in self.phases)
+        logger.info(f"Бот готов через {self.elapsed():.2f} с после старта процесса: {breakdown}")
+
+
+class WebhookServer:
+    """POST /<url_path> — обновления от Telegram (проверки как у вебхука PTB), GET /metrics — метрики."""
+
+    def __init__(self, url_path: str, secret_token: str | None = None, timer: StartupTimer | None = None):
+        self.url_path, self.secret_token, self.timer = "/" + url_path.strip("/"), secret_token, timer
+        self._application = None
+        self._pending: list[dict] = []
+        self.first_update_at: float | None = None
+        self._http = HTTPServer(self._handle)
+
+    def listen(self, port: int, address: str) -> None:
+        self._http.listen(port, address=address)
+
+    async def stop(self) -> None:
+        self._http.stop(); await self._http.close_all_connections()
+
+    def attach(self, application) -> None:
+        """Бот готов: буфер уходит в очередь обновлений, дальше обновления идут в нее напрямую."""
+        self._application = application
+        pending, self._pending = self._pending, []
+        if pending: logger.info(f"Передаю боту {len(pending)} обновлений, принятых во время загрузки")
+        for data in pending: self._enqueue(data)
+
+    def _enqueue(self, data: dict) -> None:
+        from telegram import Update  # к этому моменту уже загружен вместе с ботом
+        try: update = Update.de_json(data, self._application.bot)
+        except Exception as e:
+            logger.error(f"Не удалось разобрать обновление от Telegram: {e}"); return
+        if update is None: return
+        self._application.bot.insert_callback_data(update)
+        self._application.update_queue.put_nowait(update)
+
+    def _reply(self, request: HTTPServerRequest, status: int, body: bytes = b"", content_type: str = "text/plain; charset=utf-8") -> None:
+        headers = HTTPHeaders({"Content-Type": content_type, "Content-Length": str(len(body))})
+        request.connection.write_headers(ResponseStartLine("HTTP/1.1", status, HTTPStatus(status).phrase), headers, body)
+        request.connection.finish()
+
+    def _handle(self, request: HTTPServerRequest) -> None:
+        path = request.path.rstrip("/") or "/"
+        if path == "/metrics" and request.method == "GET":
+            if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+                return self._reply(request, 403)
+            return self._reply(request, 200, metrics.render().encode(), "text/plain; version=0.0.4; charset=utf-8")
+        if path != self.url_path: return self._reply(request, 404)
+        if request.method != "POST": return self._reply(request, 405)
+        if request.headers.get("Content-Type") != "application/json": return self._reply(request, 403)
+        if self.secret_token is not None and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret_token:
+            return self._reply(request, 403)
+        try: data = json.loads(request.body)
+        except ValueError: return self._reply(request, 400)
+        if self.first_update_at is None and self.timer is not None:
+            self.first_update_at = self.timer.elapsed()
+            logger.info(f"Первое обновление принято через {self.first_update_at:.2f} с после старта процесса")
+        if self._application is not None: self._enqueue(data)
+        elif len(self._pending) < WEBHOOK_BUFFER_MAX: self._pending.append(data)
+        else: return self._reply(request, 503)  # Telegram повторит доставку позже
+        self._reply(request, 200)
+
+
+def import_application(module: str, token: str):
+    """load_application для serve_webhook: импортирует модуль бота в потоке (цикл событий в это время
+    отвечает Telegram) и собирает приложение его build_application(token)."""
+    async def load(timer: StartupTimer):
+        bot_module = await asyncio.to_thread(importlib.import_module, module); timer.mark("import")
+        application = bot_module.build_application(token); timer.mark("build")
+        return application
+    return load
+
+
+async def serve_webhook(load_application, listen: str, port: int, url_path: str, webhook_url: str,
+                        secret_token: str | None = None, timer: StartupTimer | None = None) -> None:
+    """Как Application.run_webhook, но порт открывается до загрузки бота.
+    load_application — корутина (timer) -> Application, которая загружает и собирает бота."""
+    timer = timer or StartupTimer()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM): loop.add_signal_handler(sig, stop.set)
+    server = WebhookServer(url_path, secret_token, timer)
+    server.listen(port, listen); timer.mark("listen")
+    application = None
+    try:
+        application = await load_application(timer)
+        await application.initialize(); timer.mark("initialize")
+        if application.post_init: await application.post_init(application)
+        await application.start(); server.attach(application); timer.mark("start")
+        await application.bot.set_webhook(url=webhook_url, secret_token=secret_token); timer.mark("set_webhook")
+        timer.report()
+        await stop.wait()
+    finally:
+        await server.stop()
+        if application is not None:
+            if application.running: await application.stop()
+            if application.post_stop: await application.post_stop(application)
+            await application.shutdown()
+            if application.post_shutdown: await application.post_shutdown(application)
+
+
+def run_webhook(load_application, listen: str, port: int, url_path: str, webhook_url: str,
+                secret_token: str | None = None, timer: StartupTimer | None = None) -> None:
+    asyncio.run(serve_webhook(load_application, listen, port, url_path, webhook_url, secret_token, timer))